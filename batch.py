@@ -0,0 +1,275 @@
+"""
+batch.py
+
+Headless mapping of many subjects from a configuration file (same schema as `config.json`), without Qt:
+
+    python batch.py -i <config_file> [-o <output_directory>] [-j <n_jobs>] [-m <minimum_correlation>]
+                    [-s <metric,...>] [-b <memory_mb>] [-r] [-p <trace.json>] [subject ...]
+
+Each subject is a directory (or a glob of directories) against which the `ica` directory of the configuration is
+resolved; the RSN templates and the output directory are resolved against the working directory, as in the GUI.
+Without subjects the configuration is used as-is for a single subject. Subjects are named after their directory, so
+two subject directories with the same name are refused. For every subject
+`<output_directory>/<subject>/correlations.csv` (first metric, phi by default) and `assignments.json` are written,
+plus `correlations_<metric>.csv` for every further metric. With `-b` the correlation of all jobs together keeps its
+working set within that many MB (see `mapper.Mapper.tile_shape`); a budget too small for the templates is refused
+before any subject is mapped, naming the smallest one that works. With `-r` an overview page of all
+subjects, `<output_directory>/summary.html`, is written at the end (see `reports.create_summary`). With `-p` the hot
+paths of this process are timed (see `instrument`) and written as a Chrome trace; work done in worker processes is
+not included.
+"""
+import os
+from os.path import join as opj
+import sys
+import csv
+import json
+import glob
+import time
+import getopt
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from discovery import find_files
+from images import LazyImage
+from template_bank import TemplateBank, DEFAULT_BANK_DIRECTORY
+from reports import create_summary
+import instrument
+import mapper as map
+import similarity
+
+USAGE = ('batch.py -i <config_file> [-o <output_directory>] [-j <n_jobs>] [-m <minimum_correlation>] '
+         '[-s <metric,...>] [-b <memory_mb>] [-r] [-p <trace.json>] [subject ...]')
+NULL_NETWORK = 'Random'
+
+
+def expand_subjects(patterns):
+    """Subject directories from a list of directories and/or glob patterns, in order and without duplicates."""
+    subjects = []
+    for pattern in patterns:
+        for subject in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(subject) and subject not in subjects:
+                subjects.append(subject)
+    return subjects
+
+
+def subject_name(subject):
+    return os.path.basename(os.path.normpath(subject)) if subject else 'subject'
+
+
+def check_subject_names(subjects):
+    """Raise ValueError if two subjects would write to the same output directory."""
+    seen = {}
+    for subject in subjects:
+        seen.setdefault(subject_name(subject), []).append(subject)
+    clashes = ['%s (%s)' % (name, ', '.join(dirs)) for name, dirs in sorted(seen.items()) if len(dirs) > 1]
+    if clashes:
+        raise ValueError('Subject directories with the same name would overwrite each other\'s outputs: %s'
+                         % '; '.join(clashes))
+
+
+def discover_templates(config):
+    """(network names, template paths) of the RSN templates of the configuration."""
+    found = find_files(config['rsn']['directory'], config['rsn']['template'], config['rsn']['search_pattern'])
+    return [k for k, _ in found], [f for _, f in found]
+
+
+def discover_components(config, subject=None):
+    """(component names, file paths) of the ICA components of one subject."""
+    directory = opj(subject, config['ica']['directory']) if subject else config['ica']['directory']
+    found = find_files(directory, config['ica']['template'], config['ica']['search_pattern'])
+    return [k for k, _ in found], [f for _, f in found]
+
+
+def write_scores(csv_file, names, files, scores, network_names):
+    """One row per component (`names`/`files`), one column per network."""
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['component'] + network_names)
+        for name, file_name in zip(names, files):
+            writer.writerow([name] + ['%.6f' % c for c in scores[file_name]])
+
+
+def map_subject(subject, config, network_names, template_files, output_directory, minimum_correlation=0.5,
+                bank_directory=DEFAULT_BANK_DIRECTORY, n_jobs=1, metrics=('phi',), memory_budget=None,
+                memory_workers=1):
+    """
+    Correlate and assign the components of one subject, write its outputs and return a short summary. The
+    `memory_budget` is shared with `memory_workers` - 1 other subjects mapped at the same time.
+    """
+    start = time.time()
+    names, files = discover_components(config, subject)
+    out_dir = opj(output_directory, subject_name(subject))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if not files:
+        return {'subject': subject_name(subject), 'components': 0, 'assigned': 0, 'seconds': time.time() - start}
+
+    mapper = map.Mapper(map_files=template_files, in_files=files, template_bank=TemplateBank(bank_directory),
+                        metrics=metrics, memory_budget=memory_budget, memory_workers=memory_workers)
+    mapper.run(n_jobs=n_jobs)
+    matches = mapper.assign_matches(minimum_correlation=minimum_correlation, null_network=NULL_NETWORK)
+    network_of = dict(zip(template_files, network_names))
+
+    write_scores(opj(out_dir, 'correlations.csv'), names, files, mapper.corr, network_names)
+    for metric in mapper.metrics[1:]:
+        write_scores(opj(out_dir, 'correlations_%s.csv' % metric), names, files, mapper.scores[metric],
+                     network_names)
+
+    assignments = {}
+    for name, file_name in zip(names, files):
+        corr = mapper.corr[file_name]
+        top = int(np.argmax(corr))
+        assignments[name] = {'file': file_name,
+                             'network': network_of.get(matches[file_name], matches[file_name]),
+                             'best_match': network_names[top],
+                             'correlation': float(corr[top])}
+    with open(opj(out_dir, 'assignments.json'), 'w') as f:
+        json.dump(assignments, f, indent=2, sort_keys=True)
+
+    assigned = sum(1 for a in assignments.values() if a['network'] != NULL_NETWORK)
+    return {'subject': subject_name(subject), 'components': len(files), 'assigned': assigned,
+            'seconds': time.time() - start}
+
+
+def _map_subject_task(args):
+    subject, kwargs = args
+    return map_subject(subject, **kwargs)
+
+
+def prepare_template_bank(config, subjects, template_files, bank_directory, threshold=0.5):
+    """
+    Build or refresh the template bank once per grid, before the subjects are spread over worker processes. Returns
+    the template masks of every grid, as the subjects will read them from the bank.
+    """
+    bank, grids = TemplateBank(bank_directory), {}
+    for subject in subjects:
+        files = discover_components(config, subject)[1]
+        if files:
+            reference = LazyImage(files[0])
+            key = TemplateBank.grid_key(reference, threshold)
+            if key not in grids:
+                grids[key] = bank.masks(template_files, reference, threshold=threshold)
+    return list(grids.values())
+
+
+def check_memory_budget(memory_budget, grids, metrics, n_workers):
+    """
+    Raise ValueError, naming the smallest total that works, if `n_workers` subjects mapped at the same time cannot
+    keep within `memory_budget` bytes on every grid (template masks as returned by `prepare_template_bank`).
+    """
+    continuous = any(m in similarity.CONTINUOUS_METRICS for m in metrics)
+    for map_arr in grids:
+        # the bank file is mapped by every worker; template values are computed by each
+        shared = not continuous and map.Mapper.shared_templates(map_arr, None)
+        map.Mapper.tile_shape(1, len(map_arr), map_arr.n_voxels, memory_budget, continuous=continuous,
+                              n_workers=n_workers, shared=shared)
+
+
+def run_batch(config, subjects=None, output_directory=None, n_jobs=1, minimum_correlation=0.5, metrics=('phi',),
+              memory_budget=None, log=sys.stderr):
+    """
+    Map every subject, `n_jobs` at a time (-1 uses every core), printing progress to `log`. A `memory_budget` (bytes)
+    is shared between the jobs; ValueError is raised before any subject is mapped if it is too small.
+    """
+    subjects = subjects or [None]
+    check_subject_names(subjects)
+    output_directory = output_directory or config['output_directory']
+    bank_directory = config.get('template_bank', DEFAULT_BANK_DIRECTORY)
+    network_names, template_files = discover_templates(config)
+    grids = prepare_template_bank(config, subjects, template_files, bank_directory)
+
+    n_jobs = cpu_count() if n_jobs < 1 else n_jobs
+    kwargs = {'config': config, 'network_names': network_names, 'template_files': template_files,
+              'output_directory': output_directory, 'minimum_correlation': minimum_correlation,
+              'bank_directory': bank_directory, 'metrics': metrics}
+    if len(subjects) == 1:  # a single subject spreads its components over the workers instead
+        results = iter([map_subject(subjects[0], n_jobs=n_jobs, memory_budget=memory_budget, **kwargs)])
+        pool = None
+    else:
+        n_jobs = min(n_jobs, len(subjects))
+        if memory_budget is not None:
+            check_memory_budget(memory_budget, grids, metrics, n_jobs)
+        kwargs.update(memory_budget=memory_budget, memory_workers=n_jobs)
+        pool = Pool(processes=n_jobs)
+        results = pool.imap_unordered(_map_subject_task, [(subject, kwargs) for subject in subjects])
+    summaries = []
+    try:
+        for i, summary in enumerate(results, 1):
+            summaries.append(summary)
+            log.write('[%d/%d] %s: %d components, %d assigned (%.1f s)\n'
+                      % (i, len(subjects), summary['subject'], summary['components'], summary['assigned'],
+                         summary['seconds']))
+            log.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return summaries
+
+
+def main(argv):
+    config_file, output_directory, n_jobs, minimum_correlation, metrics = None, None, 1, 0.5, ('phi',)
+    summary, trace_file, memory_budget = False, None, None
+    try:
+        opts, args = getopt.getopt(argv, "hi:o:j:m:s:b:rp:", ["config_file=", "output_directory=", "n_jobs=",
+                                                             "minimum_correlation=", "metrics=", "memory=",
+                                                             "summary", "trace="])
+    except getopt.GetoptError:
+        sys.stderr.write(USAGE + '\n')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            sys.stdout.write(USAGE + '\n')
+            sys.exit()
+        elif opt in ("-i", "--config_file"):
+            config_file = arg
+        elif opt in ("-o", "--output_directory"):
+            output_directory = arg
+        elif opt in ("-j", "--n_jobs"):
+            n_jobs = int(arg)
+        elif opt in ("-m", "--minimum_correlation"):
+            minimum_correlation = float(arg)
+        elif opt in ("-s", "--metrics"):
+            metrics = tuple(m.strip() for m in arg.split(','))
+        elif opt in ("-b", "--memory"):
+            memory_budget = int(float(arg) * 1024 ** 2)
+        elif opt in ("-r", "--summary"):
+            summary = True
+        elif opt in ("-p", "--trace"):
+            trace_file = arg
+            instrument.enable()
+    if config_file is None:
+        sys.stderr.write(USAGE + '\n')
+        sys.exit(2)
+
+    subjects = expand_subjects(args)
+    if args and not subjects:
+        sys.stderr.write('No subject directories match %s\n' % ' '.join(args))
+        sys.exit(2)
+    try:
+        check_subject_names(subjects)
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(2)
+
+    with open(config_file) as json_config:
+        config = json.load(json_config)
+    try:
+        run_batch(config, subjects, output_directory=output_directory, n_jobs=n_jobs,
+                  minimum_correlation=minimum_correlation, metrics=metrics, memory_budget=memory_budget)
+    except ValueError as e:  # e.g. a memory budget too small for the templates
+        sys.stderr.write('%s\n' % e)
+        sys.exit(2)
+    if summary:
+        html_file = create_summary(output_directory or config['output_directory'],
+                                   [subject_name(subject) for subject in subjects or [None]], n_jobs=n_jobs,
+                                   metric=metrics[0])
+        sys.stderr.write('Summary written to %s\n' % html_file)
+    if trace_file:
+        instrument.export_chrome_trace(trace_file)
+        sys.stderr.write('%s\n' % instrument.status_line(max_items=8))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,138 @@
+"""
+discovery.py
+
+File discovery driven by the `template`/`search_pattern` fields of the configuration file, without Qt.
+
+Directories are listed with `scandir` and every listing is cached, keyed by the directory and its mtime (which changes
+whenever an entry is added, removed or renamed), so that rescanning an unchanged study tree only stats its
+directories. `read_headers` opens the NIfTI headers of the files found on a pool of threads and keeps the handles
+of files whose size and mtime did not change.
+"""
+import os
+import re
+import fnmatch
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:  # python 2, without the scandir backport
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from images import LazyImage
+import instrument
+
+HEADER_THREADS = 8
+
+_lock = threading.Lock()
+_listings = {}  # absolute directory -> (mtime, [(name, is_dir)])
+_headers = {}  # (absolute path, size, mtime) -> LazyImage
+
+
+def match_key(regex, file_name):
+    """
+    Lookup key (first group of `regex`) for `file_name`, or None. Configuration patterns are often written with
+    Windows separators, so the path is also tried with every separator replaced by a backslash.
+    """
+    for candidate in (file_name, file_name.replace(os.sep, '\\')):
+        match = regex.search(candidate)
+        if match:
+            return match.groups()[0]
+    return None
+
+
+def list_directory(directory):
+    """[(name, is_dir)] of the entries of `directory`, cached until its mtime changes; [] if it cannot be read."""
+    key = os.path.abspath(directory)
+    try:
+        mtime = os.stat(key).st_mtime
+    except OSError:
+        return []
+    with _lock:
+        cached = _listings.get(key)
+    if cached is not None and cached[0] == mtime:
+        instrument.count('discovery.hits')
+        return cached[1]
+    instrument.count('discovery.misses')
+    try:
+        if scandir is not None:
+            entries = [(entry.name, entry.is_dir()) for entry in scandir(key)]
+        else:
+            entries = [(name, os.path.isdir(os.path.join(key, name))) for name in os.listdir(key)]
+    except OSError:
+        return []
+    with _lock:
+        _listings[key] = (mtime, entries)
+    return entries
+
+
+def _matches(names, pattern):
+    """Names matching one glob segment; as with `glob`, hidden names only match patterns starting with a dot."""
+    if not pattern.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    return fnmatch.filter(names, pattern)
+
+
+def scan(directory, template='*'):
+    """Paths of `directory` matching the glob `template` (e.g. '*' or '*/*.nii.gz'), like `glob.glob`, sorted."""
+    segments = [s for s in re.split(r'[\\/]', template) if s and s != '.']
+    paths = [directory]
+    for depth, segment in enumerate(segments):
+        last = depth == len(segments) - 1
+        next_paths = []
+        for path in paths:
+            entries = list_directory(path)
+            names = [name for name, is_dir in entries if last or is_dir]
+            next_paths.extend(os.path.join(path, name) for name in _matches(names, segment))
+        paths = next_paths
+    return sorted(paths)
+
+
+def find_files(directory, template='*', search_pattern=r'(\w+)(\.nii\.gz|\.nii)$'):
+    """
+    Files of `directory` matching the glob `template` and the regular expression `search_pattern`, sorted by path, as
+    a list of (lookup_key, file_path) where the lookup key is the first group of the pattern.
+    """
+    regex = re.compile(search_pattern)
+    found = []
+    for file_name in scan(directory, template):
+        lookup_key = match_key(regex, file_name)
+        if lookup_key is not None:
+            found.append((lookup_key, file_name))
+    return found
+
+
+def _read_header(file_name):
+    st = os.stat(file_name)
+    key = (os.path.abspath(file_name), st.st_size, st.st_mtime)
+    with _lock:
+        handle = _headers.get(key)
+    if handle is None:
+        handle = LazyImage(file_name)  # header only
+        with _lock:
+            _headers[key] = handle
+    return handle
+
+
+def read_headers(file_names, n_threads=HEADER_THREADS):
+    """`LazyImage` handles of `file_names`, in order; headers not read before are read on `n_threads` threads."""
+    file_names = list(file_names)
+    n_threads = max(1, min(n_threads, len(file_names)))
+    if n_threads == 1:
+        return [_read_header(f) for f in file_names]
+    pool = ThreadPool(processes=n_threads)
+    try:
+        return pool.map(_read_header, file_names)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def clear_cache():
+    """Forget the cached listings and headers."""
+    with _lock:
+        _listings.clear()
+        _headers.clear()
@@ -0,0 +1,33 @@
+"""
+files.py
+
+Small file helpers shared by the template bank, the time-series store and report generation: content hashes, cheap
+identities of large files and atomic replacement of a file written under a temporary name.
+"""
+import os
+import hashlib
+
+
+def file_hash(file_name, block_size=1 << 20):
+    """SHA-1 of the (compressed) file contents."""
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_identity(file_name):
+    """Cheap identity of a (large) file from its path, size and mtime."""
+    st = os.stat(file_name)
+    return hashlib.sha1(repr((os.path.abspath(file_name), st.st_size, int(st.st_mtime))).encode('utf8')).hexdigest()
+
+
+def replace_file(src, dst):
+    """Atomically move `src` over `dst` (os.replace is missing on python 2)."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
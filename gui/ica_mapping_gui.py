@@ -4,30 +4,62 @@ ica_mapping_gui.py
 
 # Python Libraries and QT
 from os.path import join as opj  # method to join strings of file paths
-import os, sys, re, getopt, json
+import os, sys, getopt, json
 from functools import partial
 from PyQt4 import QtGui, QtCore, Qt  # Import QT
 mypath = os.getcwd()
 sys.path.append(opj(mypath, '..\\'))
 
 # Mathematical/Neuroimaging/Plotting Libraries
+# nilearn is only imported where first used, so that the window appears without waiting for it
 import numpy as np  # Library to for all mathematical operations
-from nilearn import plotting, image, input_data  # library for neuroimaging
-from nibabel.nifti1 import Nifti1Image
-import nipype.interfaces.io as nio
-import matplotlib.pyplot as plt  # Plotting library
-import matplotlib.gridspec as gridspec
+from matplotlib.figure import Figure  # Plotting library; pyplot's figure manager is not needed inside Qt
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 
 # Internal imports
-from settings import mri_plots as mp, time_plots as tp  # use items in settings file
+from settings import mri_plots as mp, time_plots as tp, render_cache as rc, \
+    slice_viewer as sv, reports as rp, instrumentation as ins, discovery as ds, \
+    timeseries as tss  # use items in settings file
 import design  # This file holds our MainWindow and all design related things
-from reports import create_html
+import plots
+from workers import AnalysisWorker, PrecomputeWorker, ReportWorker, TimeSeriesWorker
+from render_cache import RenderCache, Prefetcher, view_key, render
+from slice_viewer import SliceViewer
 import mapper as map
+import instrument
+import discovery
+from images import LazyImage, as_img, is_image, image_path, image_identity
+from template_bank import TemplateBank, DEFAULT_BANK_DIRECTORY
+from timeseries import TimeSeriesStore, DEFAULT_CACHE_DIRECTORY
 
 ANATOMICAL_TO_TIMESERIES_PLOT_RATIO = 5
 CONFIGURATION_FILE = '../config.json'
 
+
+def time_series_args(store, components, show_time_individual=False, show_time_average=False, ica_lookup=None,
+                     show_spectrum=False, show_time_group=False, coords=(0,0,0), significance_threshold=0.5,
+                     *args, **kwargs):
+    """
+    Arguments of `plots.plot_time_series` for a set of plot options, signals read from the time-series `store` (left
+    out if it is None) and the mean signal taken over the (ICA lookup, image) `components`, of which the first call
+    extracts every one in a single pass. Reads no GUI state, so that the report thread can use it.
+    """
+    average = None
+    if show_time_average and store is not None:
+        lookups = [k for k, _ in components]
+        signals = store.mean_signals([img for _, img in components], threshold=significance_threshold)
+        average = signals[lookups.index(ica_lookup)]
+    return {'individual': store.voxel_signal(coords) if show_time_individual and store is not None else None,
+            'average': average, 'show_group': show_time_group, 'show_spectrum': show_spectrum, 'coords': coords}
+
+
+def prepare_report_job(store, components, job):
+    """Picklable job for `reports.render_report`; runs on the report thread since it may read the fMRI."""
+    job = dict(job)
+    job['time_series'] = time_series_args(store, components, **job.pop('options'))
+    return job
+
+
 class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
     """
     Mapping GUI
@@ -37,6 +69,23 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         self.setupUi(self)  # This is defined in design.py file automatically; created in QT Designer
         self.gd = {}  # gui data; dict of dict where gd[class][unique_name][file_path, nilearn image object]
         self.computed_analysis = False
+        self.analysis_worker = None  # background correlation of the selected component
+        self.precompute_worker = None  # background correlation of every component, started on configuration load
+        self.partial_corr = {}  # ica lookup -> {template column: score} while a component is being analysed
+        self.run_analysis_text = self.pushButton_runAnalysis.text()
+        self.report_worker = None  # writes the reports, see generate_report
+        self.create_report_text = self.pushButton_createReport.text()
+        self.time_series_store = None  # fMRI signals, see time_series
+        self.time_series_worker = None  # maps (or first converts) the fMRI of the store
+        self.config = {}
+        if ins['enabled']:
+            instrument.enable()
+        if instrument.enabled():  # show where the time goes
+            self.status_timer = QtCore.QTimer(self)
+            self.status_timer.timeout.connect(self.show_instrumentation)
+            self.status_timer.start(1000)
+        self.render_cache = RenderCache(max_bytes=rc['max_bytes'])  # rendered brain views, see update_plots
+        self.prefetcher = Prefetcher(self.render_cache, self.plot_x) if rc['prefetch'] else None
         cfile = configuration_file if isinstance(configuration_file, str) else CONFIGURATION_FILE
 
         anat_sp = QtGui.QSizePolicy(QtGui.QSizePolicy.Preferred, QtGui.QSizePolicy.Preferred)
@@ -45,13 +94,15 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         ts_sp.setVerticalStretch(1)
 
         # figure instance to view spatial data
-        self.figure_x = plt.figure()
+        self.figure_x = Figure()
         self.canvas_x = FigureCanvas(self.figure_x)
         self.verticalLayout_plot.addWidget(self.canvas_x)
         self.canvas_x.setSizePolicy(anat_sp)
+        self.slice_viewer = SliceViewer(self.figure_x, self.canvas_x, threshold=sv['threshold']) \
+            if sv['enabled'] else None
 
         # fig
-        self.figure_t = plt.figure()
+        self.figure_t = Figure()
         self.canvas_t = FigureCanvas(self.figure_t)
         self.verticalLayout_plot.addWidget(self.canvas_t)
         self.canvas_t.setSizePolicy(ts_sp)
@@ -84,6 +135,7 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         self.pushButton_Plot.clicked.connect(self.update_plots)
 
         self.listWidget_ICAComponents.itemClicked.connect(self.update_gui)
+        self.listWidget_ICAComponents.currentItemChanged.connect(self.prioritize_component)
         self.listWidget_RSN.itemClicked.connect(self.update_gui)
         self.listWidget_mappedICANetworks.itemClicked.connect(self.update_mapping)
         self.listWidget_mappedICANetworks.currentItemChanged.connect(self.update_mapping)
@@ -97,24 +149,28 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         self.horizontalSlider_Xslice.sliderReleased.connect(self.update_plots)
         self.horizontalSlider_Yslice.sliderReleased.connect(self.update_plots)
         self.horizontalSlider_Zslice.sliderReleased.connect(self.update_plots)
+        self.horizontalSlider_Xslice.valueChanged.connect(self.scrub_slices)
+        self.horizontalSlider_Yslice.valueChanged.connect(self.scrub_slices)
+        self.horizontalSlider_Zslice.valueChanged.connect(self.scrub_slices)
         self.spinBox_numSlices.valueChanged.connect(self.update_plots)
 
         self.listWidget_ICAComponents.setCurrentRow(0)
         self.listWidget_RSN.setCurrentRow(0)
-        self.mapper = map.Mapper(map_files=self.get_imgobjects('rsn'), in_files=self.get_imgobjects('ica'))
 
     def update_gui(self):
         ica_name = str(self.listWidget_ICAComponents.currentItem().text())
         rsn_name = str(self.listWidget_RSN.currentItem().text())
         # print self.mapper.corr
-        if ica_name in self.mapper.corr.keys():
-            new_order = np.argsort(self.mapper.corr[ica_name])[::-1]
+        if ica_name in self.mapper.corr.keys() or ica_name in self.partial_corr:
+            scores = self.mapper.corr[ica_name] if ica_name in self.mapper.corr else self.partial_corr[ica_name]
             for i in range(self.listWidget_RSN.count()):
                 item = self.listWidget_RSN.item(i)
                 lookup = str(item.data(QtCore.Qt.UserRole).toString())
-
-                item.setText("%s (%0.2f)" %(lookup, self.mapper.corr[ica_name][i]))
-                # self.listWidget_RSN.setIt
+                column = self.rsn_columns.get(lookup)  # extra items (Noise, Other) have no template
+                if column is not None and (ica_name in self.mapper.corr or column in scores):
+                    item.setText("%s (%0.2f)" %(lookup, scores[column]))
+                else:
+                    item.setText(lookup)
         else:
             for i in range(self.listWidget_RSN.count()):
                 item = self.listWidget_RSN.item(i)
@@ -181,7 +237,7 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
 
     def load_base_file(self, file_name, file_type='fmri'):
         if file_name:
-            self.gd.update({file_type: {'full_path': file_name, 'img': image.load_img(str(file_name))}})
+            self.gd.update({file_type: {'full_path': file_name, 'img': LazyImage(str(file_name))}})
 
     def browse_folder(self, listWidget=None, search_pattern='\w+', title="Select Directory", list_name='ica'):
         directory = QtGui.QFileDialog.getExistingDirectory(self, title)
@@ -194,21 +250,29 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         if directory:
             self.lineEdit_outputDir.setText(directory)
 
+    def show_instrumentation(self):
+        self.statusbar.showMessage(instrument.status_line())
+
+    def closeEvent(self, event):
+        if instrument.enabled() and ins['trace_file']:
+            instrument.export_chrome_trace(ins['trace_file'])
+        super(MapperGUI, self).closeEvent(event)
+
     def find_files(self, directory, template, search_pattern, listWidget, list_name, extra_items=None):
+        with instrument.span('discover', directory=directory):
+            self._find_files(directory, template, search_pattern, listWidget, list_name, extra_items)
+
+    def _find_files(self, directory, template, search_pattern, listWidget, list_name, extra_items=None):
         if directory: # if user didn't pick a directory don't continue
-            ds = nio.DataGrabber(base_directory=directory, template=template, sort_filelist=True)
-            all_nifti_files = ds.run().outputs.outfiles
             listWidget.clear() # In case there are any existing elements in the list
-            r = re.compile(search_pattern)
-            list_items = []
-            for file_name in filter(r.search, all_nifti_files):
-                match = re.search(r, file_name)
-                lookup_key = match.groups()[0]
+            found = discovery.find_files(directory, template, search_pattern)
+            handles = discovery.read_headers([file_name for _, file_name in found], n_threads=ds['header_threads'])
+            for (lookup_key, file_name), handle in zip(found, handles):
                 item = QtGui.QListWidgetItem(lookup_key)
                 listWidget.addItem(item)
                 item.setData(QtCore.Qt.UserRole, lookup_key)
-                self.gd[list_name][lookup_key] = {'img': image.load_img(opj(directory, file_name)),
-                                                  'filepath': opj(directory, file_name),
+                self.gd[list_name][lookup_key] = {'img': handle,  # header only
+                                                  'filepath': file_name,
                                                   'name': lookup_key,
                                                   'widget': item}
             if extra_items:
@@ -249,127 +313,253 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         if os.path.exists(data['output_directory']):
             self.lineEdit_outputDir.setText(os.path.abspath(data['output_directory']))
         self.config = data
+        self.render_cache.clear()  # views of the previous configuration
+
+        # Binarized templates come from the on-disk bank; templates changed since the last session are rebuilt by the
+        # precompute worker before its first component, off the GUI thread
+        self.template_bank = TemplateBank(data.get('template_bank', DEFAULT_BANK_DIRECTORY))
+        rsn_items = [(k, v['filepath']) for k, v in self.gd['rsn'].items() if v['filepath'] is not None]
+        self.rsn_columns = {k: j for j, (k, _) in enumerate(rsn_items)}  # RSN lookup -> column of the mapper results
+        rsn_files = [f for _, f in rsn_items]
+        ica_imgs = self.get_imgobjects('ica')
+        self.mapper = map.Mapper(map_files=rsn_files, in_files=ica_imgs, template_bank=self.template_bank)
+        if ica_imgs and rsn_files:
+            self.start_precompute()
+
+    def start_precompute(self):
+        """Correlate every component in the background, in list order, starting from the selected one."""
+        if self.precompute_worker is not None:
+            self.precompute_worker.cancel()
+            self.precompute_worker.wait()
+        components = []
+        for i in range(self.listWidget_ICAComponents.count()):
+            lookup = str(self.listWidget_ICAComponents.item(i).data(QtCore.Qt.UserRole).toString())
+            components.append((lookup, self.gd['ica'][lookup]['img']))
+        self.precompute_worker = PrecomputeWorker(self.mapper, components, parent=self)
+        self.precompute_worker.component_ready.connect(self.component_ready)
+        current = self.listWidget_ICAComponents.currentItem()
+        if current is not None:
+            self.precompute_worker.prioritize(str(current.data(QtCore.Qt.UserRole).toString()))
+        self.precompute_worker.start(QtCore.QThread.LowPriority)
+
+    def prioritize_component(self, current, previous=None):
+        if current is not None and self.precompute_worker is not None:
+            self.precompute_worker.prioritize(str(current.data(QtCore.Qt.UserRole).toString()))
+
+    def component_ready(self, ica_lookup):
+        self.computed_analysis = True
+        current = self.listWidget_ICAComponents.currentItem()
+        if current is not None and str(current.text()) == str(ica_lookup):
+            self.update_gui()
 
     def run_analysis(self):
-        btn_txt = self.pushButton_runAnalysis.text()
-        self.pushButton_runAnalysis.setText("Creating")
+        """Correlate the selected component in the background; while it runs, the button cancels it."""
+        if self.analysis_worker is not None and self.analysis_worker.isRunning():
+            self.analysis_worker.cancel()
+            return
         lookup_val = str(self.listWidget_ICAComponents.currentItem().data(QtCore.Qt.UserRole).toString())
-        corr = self.mapper.run_one(self.gd['ica'][lookup_val]['img'], label=lookup_val) \
-            if lookup_val not in self.mapper.corr.keys() else self.mapper.corr[lookup_val]
+        if lookup_val in self.mapper.corr.keys():
+            self.update_gui()
+            return
+        if self.precompute_worker is not None and self.precompute_worker.isRunning():
+            self.precompute_worker.prioritize(lookup_val)  # shown by component_ready as soon as it is done
+            return
+        self.partial_corr[lookup_val] = {}
+        self.analysis_worker = AnalysisWorker(self.mapper, lookup_val, self.gd['ica'][lookup_val]['img'], parent=self)
+        self.analysis_worker.score_ready.connect(self.show_partial_score)
+        self.analysis_worker.finished.connect(self.analysis_finished)
+        self.pushButton_runAnalysis.setText("Cancel")
+        self.analysis_worker.start()
+
+    def show_partial_score(self, ica_lookup, column, score):
+        self.partial_corr.setdefault(str(ica_lookup), {})[column] = score
+        if str(self.listWidget_ICAComponents.currentItem().text()) == str(ica_lookup):
+            self.update_gui()
+
+    def analysis_finished(self):
+        worker = self.analysis_worker
+        self.partial_corr.pop(worker.lookup, None)  # complete results now live in mapper.corr, cancelled ones are dropped
+        self.computed_analysis = self.computed_analysis or worker.completed
+        self.pushButton_runAnalysis.setText(self.run_analysis_text)
         self.update_gui()
-        self.computed_analysis = True
-        self.pushButton_runAnalysis.setText(btn_txt)
 
     def generate_report(self):
-        btn_txt = self.pushButton_createReport.text()
+        """
+        Write one html report per mapped component, rendered on a process pool off the GUI thread. Reports whose
+        inputs did not change since they were written are skipped.
+        """
+        if self.report_worker is not None and self.report_worker.isRunning():
+            return
+        assets_directory = opj(str(self.lineEdit_outputDir.text()), rp['assets_directory']) \
+            if rp['external_assets'] else None
+        # the report thread gets a store and component list of its own instead of reading the GUI's
+        store = self.new_time_series_store() if 'fmri' in self.gd else None
+        prepare = partial(prepare_report_job, store, self.ica_components())
+        self.report_worker = ReportWorker(self.report_jobs(), prepare=prepare, assets_directory=assets_directory,
+                                          parent=self)
+        self.report_worker.progress.connect(self.report_progress)
+        self.report_worker.finished.connect(self.report_finished)
+        self.pushButton_createReport.setEnabled(False)
         self.pushButton_createReport.setText("Creating")
-        fx = plt.figure(figsize=(10,4))
-        ft = plt.figure(figsize=(10, 2))
+        self.report_worker.start()
+
+    def report_jobs(self):
+        """Description of every report; `prepare_report_job` completes them with their time series."""
         directory = str(self.lineEdit_outputDir.text())
         if not os.path.exists(directory):
             os.makedirs(directory)
-        for u, v in self.gd['mapped'].iteritems():
+        jobs = []
+        for u, v in self.gd['mapped'].items():
             options = self.get_plot_options(ica_lookup=u, rsn_lookup=v['rsn_lookup'])
-            self.plot_x(fx, **options)
-            self.plot_t(ft, **options)
-            context = {'mri_view': fx, 'time_series': ft, 'title': v['custom_name']}
-            fname = opj(directory, '%s_out.html' % u)
-            create_html(context, fname)
-        self.pushButton_createReport.setText(btn_txt)
-
-    def plot_x(self, fig, ica_lookup, rsn_lookup, display='ortho', coords=(0,0,0), show_rsn=True, show_wm=False,
-               show_csf=False, show_gm=False, show_brain=False, show_segmentation=False, *args, **kwargs):
-        anat_img = self.gd['smri']['img']
-        stat_img = self.gd['ica'][ica_lookup]['img']
-        fig.clear()
-        ax1 = fig.add_subplot(111)
-        ax1.hold(False)  # discards the old graph
-
-        d = plotting.plot_stat_map(stat_map_img=stat_img, bg_img=anat_img, axes=ax1,
-                                   title='ICA Component %s' % ica_lookup,
-                                   cut_coords=coords, display_mode=display, annotate=True,
-                                   draw_cross=True, colorbar=True)
+            jobs.append({'html_file': opj(directory, '%s_out.html' % u), 'title': str(v['custom_name']),
+                         'brain_view': self.brain_view_args(load=lambda img: image_path(img) or as_img(img),
+                                                            **options),
+                         'options': options})
+        return jobs
+
+    def report_progress(self, done, total):
+        self.pushButton_createReport.setText("Creating %d/%d" % (done, total))
+
+    def report_finished(self):
+        self.pushButton_createReport.setText(self.create_report_text)
+        self.pushButton_createReport.setEnabled(True)
+
+    def plot_x(self, fig, **options):
+        plots.plot_brain_view(fig, **self.brain_view_args(**options))
+
+    def brain_view_args(self, ica_lookup, rsn_lookup, display='ortho', coords=(0,0,0), show_rsn=True, show_wm=False,
+                        show_csf=False, show_gm=False, show_brain=False, show_segmentation=False, load=as_img,
+                        *args, **kwargs):
+        """Arguments of `plots.plot_brain_view` for a set of plot options; `load` turns gui images into its inputs."""
+        contours = []
         if show_rsn:
-            d.add_contours(self.gd['rsn'][rsn_lookup]['img'], filled=mp['rsn']['filled'], alpha=mp['rsn']['alpha'],
-                           levels=[mp['rsn']['levels']], colors=mp['rsn']['colors'])
-        if show_wm:
-            d.add_contours(self.gd['wm_mask']['img'], filled=mp['wm']['filled'], alpha=mp['wm']['alpha'],
-                           levels=[mp['wm']['levels']], colors=mp['wm']['colors'])
-        if show_csf:
-            d.add_contours(self.gd['csf_mask']['img'], filled=mp['csf']['filled'], alpha=mp['csf']['alpha'],
-                           levels=[mp['csf']['levels']], colors=mp['csf']['colors'])
-        if show_gm:
-            d.add_contours(self.gd['gm_mask']['img'], filled=mp['gm']['filled'], alpha=mp['gm']['alpha'],
-                           levels=[mp['gm']['levels']], colors=mp['gm']['colors'])
-        if show_brain:
-            d.add_contours(self.gd['brain_mask']['img'], filled=mp['brain']['filled'], alpha=mp['brain']['alpha'],
-                           levels=[mp['brain']['levels']], colors=mp['brain']['colors'])
+            contours.append((self.gd['rsn'][rsn_lookup]['img'], mp['rsn']))
+        for show, gd_key, name in ((show_wm, 'wm_mask', 'wm'), (show_csf, 'csf_mask', 'csf'),
+                                   (show_gm, 'gm_mask', 'gm'), (show_brain, 'brain_mask', 'brain')):
+            if show:
+                contours.append((self.gd[gd_key]['img'], mp[name]))
         if show_segmentation:
             # TODO: Implement Segmentations
             # d.add_contours(self.gd['segmentations']['img'], filled=True, alpha=0.2, levels=[0.5], colors='w')
             pass
-        ax1.set_axis_off()
-        fig.tight_layout(pad=0.01)
-
-    def plot_t(self, fig, show_time_individual=False, show_time_average=False, ica_lookup=None, show_spectrum=False, show_time_group=False,
-               coords=(0,0,0), significance_threshold=0.5, *args, **kwargs):
-        # Determine Axes Layout
-        if not (show_time_individual or show_time_average) and not show_time_group and not show_spectrum:
-            return  # no plot to render
-        fig.clear()
-        gs = gridspec.GridSpec(2, 5)
-        if not (show_time_individual or show_time_average) and show_time_group and not show_spectrum:
-            axgr = plt.subplot(gs[:, :])
-        if not (show_time_individual or show_time_average) and show_time_group and show_spectrum:
-            axgr, axps = plt.subplot(gs[:, 3:]), plt.subplot(gs[:, :3])
-        if (show_time_individual or show_time_average) and not show_time_group and not show_spectrum:
-            axts = plt.subplot(gs[:, :])
-        if (show_time_individual or show_time_average) and show_time_group and not show_spectrum:
-            axts, axgr = plt.subplot(gs[:, 3:]), plt.subplot(gs[:, :3])
-        if (show_time_individual or show_time_average) and show_time_group and show_spectrum:
-            axts, axgr, axps = plt.subplot(gs[:, 3:]), plt.subplot(gs[0, :3]), plt.subplot(gs[1, :3])
-
-        # Process Data & Plot
-        dat = np.abs(self.gd['ica'][ica_lookup]['img'].get_data().astype(np.float)) > significance_threshold
-        masked = image.new_img_like(self.gd['smri']['img'], dat.astype(np.int))
-        if show_time_individual:
-            try:
-                seed_masker = input_data.NiftiSpheresMasker(mask_img=masked, seeds=[coords], radius=0, detrend=False,
-                                                            standardize=False, t_r=4., memory='nilearn_cache',
-                                                            memory_level=1, verbose=0)
-                ind_ts = seed_masker.fit_transform(self.gd['fmri']['img'])
-            except:
-                ind_ts = []
-            plt.plot(ind_ts, axes=axts, label='Voxel (%d, %d, %d) Time-Series' % (coords[0], coords[1], coords[2]))
-            plt.xlabel('Time (s)')
-            plt.ylabel('fMRI signal')
-            axts.hold(True)
-        if show_time_average:
-            brain_masker = input_data.NiftiMasker(mask_img=masked,
-                                                  t_r=4.,memory='nilearn_cache', memory_level=1, verbose=0)
-
-            ts = brain_masker.fit_transform(self.gd['fmri']['img'])
-            ave_ts = np.mean(ts, axis=1)
-            plt.plot(ave_ts, axes=axts, label="Average Signal")
-            plt.xlabel('Time (s)')
-            plt.ylabel('fMRI signal')
-            axts.hold(False)
-        if show_time_group:
-            # TODO: Plot Group Logic
-            pass
-        if show_spectrum:
-            # TODO: Plot Power Spectrum Logic
-            pass
-        plt.tight_layout(pad=0.1)
+        return {'anat_img': load(self.gd['smri']['img']), 'stat_img': load(self.gd['ica'][ica_lookup]['img']),
+                'title': 'ICA Component %s' % ica_lookup, 'display': display, 'coords': coords,
+                'contours': [(load(img), style) for img, style in contours]}
+
+    def render_key(self, options, size, dpi):
+        """Render cache key of the brain view of `options`, identifying the files of every image it draws."""
+        args = self.brain_view_args(load=image_identity, **options)
+        images = (args['anat_img'], args['stat_img']) + tuple(img for img, _ in args['contours'])
+        return view_key(options, size, dpi, images=images)
+
+    def plot_t(self, fig, **options):
+        signals = options.get('show_time_individual') or options.get('show_time_average')
+        store = self.time_series() if signals and 'fmri' in self.gd else None
+        plots.plot_time_series(fig, **time_series_args(store, self.ica_components(), **options))
+
+    def ica_components(self):
+        """(lookup, image) of every loaded ICA component."""
+        return [(k, v['img']) for k, v in self.gd['ica'].items() if is_image(v['img'])]
+
+    def new_time_series_store(self):
+        """A new time-series store of the loaded fMRI; its 4-D file is only read once a signal is needed."""
+        directory = self.config.get('timeseries_cache', tss['directory'] or DEFAULT_CACHE_DIRECTORY)
+        return TimeSeriesStore(str(self.gd['fmri']['full_path']), directory=directory,
+                               max_cache_bytes=tss['max_cache_bytes'])
+
+    def time_series(self):
+        """
+        Time-series store of the loaded fMRI, for the GUI thread. If its 4-D file has to be converted first, that is
+        done once on a `TimeSeriesWorker` and None is returned until the plots are updated when it has finished.
+        """
+        store = self.time_series_store
+        if store is None or store.fmri_file != str(self.gd['fmri']['full_path']):
+            store = self.time_series_store = self.new_time_series_store()
+        if store.ready:
+            return store
+        if self.time_series_worker is None or self.time_series_worker.store is not store:
+            self.time_series_worker = TimeSeriesWorker(store, parent=self)
+            self.time_series_worker.finished.connect(self.time_series_ready)
+            self.time_series_worker.start()
+        return None
+
+    def time_series_ready(self):
+        if self.time_series_worker is not None and self.time_series_worker.store is self.time_series_store:
+            self.update_plots()
 
     def update_plots(self):
         ica_lookup, rsn_lookup = self.get_current_networks()
         options = self.get_plot_options(ica_lookup, rsn_lookup)
-        self.plot_x(self.figure_x, **options)
-        self.canvas_x.draw()
+        if self.slice_viewer is not None and options['display'] == 'ortho':
+            self.show_slices(options)
+        else:
+            self.show_view_x(options)
         self.plot_t(self.figure_t, **options)
         self.canvas_t.draw()
 
+    def show_slices(self, options):
+        """Ortho view through the slice viewer; volumes are only resampled when the component or overlays change."""
+        overlays = []
+        if options.get('show_rsn'):
+            overlays.append(('rsn', self.gd['rsn'][options['rsn_lookup']]['img']))
+        for name, gd_key in (('wm', 'wm_mask'), ('csf', 'csf_mask'), ('gm', 'gm_mask'), ('brain', 'brain_mask')):
+            if options.get('show_%s' % name):
+                overlays.append((name, self.gd[gd_key]['img']))
+        images = [self.gd['smri']['img'], self.gd['ica'][options['ica_lookup']]['img']] + [img for _, img in overlays]
+        key = (options['ica_lookup'], options['rsn_lookup'], tuple(name for name, _ in overlays),
+               tuple(image_identity(img) for img in images))
+        self.slice_viewer.set_volumes(key, as_img(self.gd['smri']['img']),
+                                      as_img(self.gd['ica'][options['ica_lookup']]['img']),
+                                      [(as_img(img), mp[name]['levels'], mp[name]['colors'], mp[name]['alpha'])
+                                       for name, img in overlays])
+        self.slice_viewer.show(options['coords'])
+
+    def scrub_slices(self):
+        """Follow the sliders while they move; only the ortho slice viewer is fast enough for this."""
+        x, y, z = self.get_and_set_slice_coordinates()
+        if self.slice_viewer is not None and self.slice_viewer.key is not None \
+                and self.buttonGroup_xview.checkedButton() == self.radioButton_ortho:
+            self.slice_viewer.show((x, y, z))
+
+    def show_view_x(self, options):
+        """Show the brain view of `options`, rendered once and then served from the render cache."""
+        if self.slice_viewer is not None:
+            self.slice_viewer.reset()  # the figure is redrawn below
+        size, dpi = (self.canvas_x.width(), self.canvas_x.height()), self.figure_x.dpi
+        key = self.render_key(options, size, dpi)
+        bitmap = self.render_cache.get(key)
+        if bitmap is None:
+            with instrument.span('render_view'):
+                bitmap = render(self.plot_x, options, size, dpi)
+            self.render_cache.put(key, bitmap)
+        self.figure_x.clear()
+        ax = self.figure_x.add_axes([0, 0, 1, 1])
+        ax.imshow(bitmap, interpolation='nearest')
+        ax.set_axis_off()
+        self.canvas_x.draw()
+        if self.prefetcher is not None:
+            self.prefetcher.request([(self.render_key(o, size, dpi), o, size, dpi)
+                                     for o in self.neighbour_views(options)])
+
+    def neighbour_views(self, options):
+        """Plot options one slider step away on each axis (ortho view), then of the previous and next components."""
+        views = []
+        if options['display'] == 'ortho':
+            sliders = (self.horizontalSlider_Xslice, self.horizontalSlider_Yslice, self.horizontalSlider_Zslice)
+            for axis, slider in enumerate(sliders):
+                for step in (slider.singleStep(), -slider.singleStep()):
+                    value = options['coords'][axis] + step
+                    if slider.minimum() <= value <= slider.maximum():
+                        coords = list(options['coords'])
+                        coords[axis] = value
+                        views.append(dict(options, coords=tuple(coords)))
+        row = self.listWidget_ICAComponents.currentRow()
+        for neighbour in (row + 1, row - 1):
+            item = self.listWidget_ICAComponents.item(neighbour)
+            if item is not None:
+                views.append(dict(options, ica_lookup=str(item.data(QtCore.Qt.UserRole).toString())))
+        return views
+
     def apply_slice_views(self):
         x, y, z = self.get_and_set_slice_coordinates()
         num_slices = int(self.spinBox_numSlices.text())
@@ -403,7 +593,7 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
     def get_plot_options(self, ica_lookup, rsn_lookup):
         display, coords = self.apply_slice_views()
         options = {'ica_lookup': ica_lookup, 'rsn_lookup': rsn_lookup, 'display': display, 'coords': coords}
-        if isinstance(self.gd['rsn'][rsn_lookup]['img'], Nifti1Image):
+        if is_image(self.gd['rsn'][rsn_lookup]['img']):
             options.update({'show_rsn': True})
         if self.checkBox_showWM.isChecked() and 'wm_mask' in self.gd.keys():
             options.update({'show_wm': True})
@@ -429,7 +619,7 @@ class MapperGUI(QtGui.QMainWindow, design.Ui_MainWindow):
         return self.get_guiitem(list_name, 'filepath')
 
     def get_imgobjects(self, list_name):
-        return [img for img in self.get_guiitem(list_name, 'img') if isinstance(img, Nifti1Image)]
+        return [img for img in self.get_guiitem(list_name, 'img') if is_image(img)]
 
     def get_guiitem(self, list_name, prop):
         return [v[prop] for v in self.gd[list_name].itervalues()]
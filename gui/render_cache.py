@@ -0,0 +1,128 @@
+"""
+render_cache.py
+
+Cache of rendered brain views. A view is rendered once into an offscreen Agg figure and kept as an RGBA bitmap, so
+returning to it (or stepping onto a slice that was prefetched in the background) only has to blit the pixels.
+matplotlib and nilearn plotting are not thread-safe (font and mathtext caches, rcParams), so views are rendered one at
+a time, whichever thread asks.
+"""
+from collections import OrderedDict
+import sys
+import threading
+import traceback
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import instrument
+
+BRAIN_OVERLAYS = ('show_rsn', 'show_wm', 'show_csf', 'show_gm', 'show_brain', 'show_segmentation')
+
+_render_lock = threading.Lock()  # held by `render` on the GUI and the prefetch thread
+
+
+def view_key(options, size, dpi, images=()):
+    """
+    Hashable key of a view from its plot options (ICA, RSN, display mode, coords, brain overlays), the identities of
+    the images it draws (`images`, e.g. their file paths, so that files loaded later under the same lookups are not
+    shown from stale bitmaps) and the figure geometry (`size` in pixels). Time-series options do not change the view.
+    """
+    overlays = tuple(k for k in BRAIN_OVERLAYS if options.get(k))
+    coords = tuple(float(c) for c in np.ravel(options['coords']))
+    return (options['ica_lookup'], options['rsn_lookup'], options['display'], coords, overlays, tuple(images),
+            tuple(int(s) for s in size), int(dpi))
+
+
+def render(plot, options, size, dpi):
+    """RGBA bitmap of `plot(fig, **options)` drawn into an offscreen figure of `size` (width, height) pixels."""
+    with _render_lock:
+        fig = Figure(figsize=(size[0] / float(dpi), size[1] / float(dpi)), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        plot(fig, **options)
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+
+class RenderCache(object):
+    """
+    Least recently used store of rendered bitmaps, bounded by `max_bytes`. Shared by the GUI thread and the prefetch
+    thread, so every access holds a lock.
+    """
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._bitmaps = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            bitmap = self._bitmaps.pop(key, None)
+            if bitmap is None:
+                self.misses += 1
+                instrument.count('render_cache.misses')
+                return None
+            self._bitmaps[key] = bitmap  # most recently used
+            self.hits += 1
+            instrument.count('render_cache.hits')
+            return bitmap
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._bitmaps
+
+    def put(self, key, bitmap):
+        with self._lock:
+            old = self._bitmaps.pop(key, None)
+            self._nbytes -= old.nbytes if old is not None else 0
+            self._bitmaps[key] = bitmap
+            self._nbytes += bitmap.nbytes
+            while self._nbytes > self.max_bytes and len(self._bitmaps) > 1:
+                self._nbytes -= self._bitmaps.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._bitmaps.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+
+class Prefetcher(object):
+    """
+    Renders views into a `RenderCache` on a background thread. `request()` replaces whatever is still queued, so
+    only the neighbours of the view currently on screen are ever worked on.
+    """
+    def __init__(self, cache, plot):
+        self.cache, self.plot = cache, plot
+        self._queue = []
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='render-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self, views):
+        """Queue (key, options, size, dpi) tuples, nearest first, dropping anything queued before."""
+        with self._condition:
+            self._queue = [v for v in views if v[0] not in self.cache]
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                key, options, size, dpi = self._queue.pop(0)
+            if key in self.cache:
+                continue
+            try:
+                self.cache.put(key, render(self.plot, options, size, dpi))
+            except Exception:  # rendered again (and failing visibly) when it is shown
+                instrument.count('render_cache.prefetch_errors')
+                sys.stderr.write('Prefetching a view failed:\n%s' % traceback.format_exc())
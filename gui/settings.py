@@ -39,3 +39,31 @@ mri_plots = {
 
 time_plots ={}
 
+render_cache = {
+    "max_bytes": 256 * 1024 ** 2,  # rendered brain views kept in memory
+    "prefetch": True,  # render neighbouring slices and components in the background
+}
+
+slice_viewer = {
+    "enabled": True,  # ortho view drawn by the incremental slice viewer instead of a full nilearn render
+    "threshold": 0.5,  # |ICA value| below which the component is transparent
+}
+
+reports = {
+    "external_assets": False,  # write figures as shared png files next to the pages instead of inline
+    "assets_directory": "assets",  # relative to the output directory
+}
+
+timeseries = {
+    "directory": "",  # converted fMRI files and component signals; "" for ~/.ica_mapping/timeseries
+    "max_cache_bytes": 4 * 1024 ** 3,  # converted fMRI files kept on disk before the least recently used are deleted
+}
+
+discovery = {
+    "header_threads": 8,  # NIfTI headers of the listed components and templates read in parallel
+}
+
+instrumentation = {
+    "enabled": False,  # time hot paths and show the slowest in the status bar (also set by ICA_MAPPING_TRACE)
+    "trace_file": "",  # if set, a Chrome trace of the session is written there on exit
+}
@@ -0,0 +1,126 @@
+"""
+slice_viewer.py
+
+Incremental orthogonal slice viewer. The anatomical image, the ICA component and the mask overlays are resampled onto
+one display grid when a component is shown; moving the slice sliders afterwards only swaps the 2-D arrays of the
+existing matplotlib artists and blits them, without clearing the figure or resampling anything again.
+"""
+import numpy as np
+from matplotlib.colors import ListedColormap
+
+import instrument
+from images import voxel_data
+
+
+def _slices(volume, ijk):
+    """Sagittal, coronal and axial slices of `volume` through voxel `ijk`, oriented for `imshow(origin='lower')`."""
+    i, j, k = ijk
+    return volume[i, :, :].T, volume[:, j, :].T, volume[:, :, k].T
+
+
+class SliceViewer(object):
+    """
+    Ortho view (sagittal, coronal, axial) of an ICA component over the anatomical image, drawn into `fig`. Call
+    `set_volumes()` once per component/overlay set and `show()` for every new cut position.
+    """
+    def __init__(self, fig, canvas, threshold=0.5):
+        self.fig, self.canvas, self.threshold = fig, canvas, threshold
+        self.key = None  # what the current volumes were built from, see set_volumes
+        self.axes, self.layers, self.cross = [], [], []
+        self.background = None
+        self.ijk = None  # voxel the cuts currently go through
+        self.canvas.mpl_connect('draw_event', self._grab_background)
+
+    def set_volumes(self, key, anat_img, stat_img, overlays=()):
+        """
+        Resample `stat_img` and the (img, level, color, alpha) `overlays` onto the grid of `anat_img` and rebuild the
+        artists. Does nothing if `key` is the one the current volumes were built from.
+        """
+        if key == self.key:
+            return
+        with instrument.span('resample', view='slices'):
+            self._build(key, anat_img, stat_img, overlays)
+
+    def _build(self, key, anat_img, stat_img, overlays):
+        from nilearn import image  # imported on first use to keep GUI startup short
+        from nilearn.plotting import cm
+        anat_img = image.reorder_img(anat_img, resample='continuous')  # axis-aligned, so slices are plain indexing
+        self.inverse_affine = np.linalg.inv(anat_img.affine)
+        anat = voxel_data(anat_img)
+        stat = voxel_data(image.resample_to_img(stat_img, anat_img))
+        vmax = float(np.abs(stat).max()) or 1.
+        volumes = [(anat, {'cmap': 'gray'}),
+                   (np.ma.masked_less(np.abs(stat), self.threshold).filled(0) * np.sign(stat),
+                    {'cmap': cm.cold_hot, 'vmin': -vmax, 'vmax': vmax})]
+        for img, level, color, alpha in overlays:
+            mask = np.asanyarray(image.resample_to_img(img, anat_img, interpolation='nearest').dataobj) >= level
+            volumes.append((mask, {'cmap': ListedColormap([color]), 'alpha': alpha}))
+        self.volumes, self.shape = volumes, anat.shape[:3]
+
+        self.fig.clear()
+        self.axes = [self.fig.add_subplot(1, 3, n + 1) for n in range(3)]
+        self.layers, self.cross = [], []
+        center = tuple(s // 2 for s in self.shape)
+        for volume, style in volumes:
+            masked = volume is not anat  # only the anatomy is opaque, elsewhere 0 / False shows through
+            artists = []
+            for ax, data in zip(self.axes, _slices(volume, center)):
+                data = np.ma.masked_equal(data, 0) if masked else data
+                artists.append(ax.imshow(data, origin='lower', interpolation='nearest', animated=True, **style))
+            self.layers.append((volume, masked, artists))
+        for ax in self.axes:
+            ax.set_axis_off()
+            self.cross.append((ax.axvline(0, color='w', lw=0.5, animated=True),
+                               ax.axhline(0, color='w', lw=0.5, animated=True)))
+        self.fig.tight_layout(pad=0.01)
+        self.key, self.ijk = key, center
+        self.canvas.draw()  # draws the static parts and grabs the background
+
+    def reset(self):
+        """Forget the current volumes, e.g. after something else was drawn into the figure."""
+        self.key, self.background, self.ijk = None, None, None
+
+    def _grab_background(self, event=None):
+        """
+        Keep the static parts of a full redraw (resize, expose) and blit the animated artists back over them, which a
+        full redraw leaves out.
+        """
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        if self.key is not None and self.ijk is not None:
+            self._blit()
+
+    def voxel(self, coords):
+        """Display-grid voxel nearest to world `coords` (mm), clipped to the volume."""
+        ijk = np.dot(self.inverse_affine, list(coords[:3]) + [1.])[:3]
+        return tuple(int(np.clip(np.round(c), 0, s - 1)) for c, s in zip(ijk, self.shape))
+
+    def show(self, coords):
+        """Move the cuts to world `coords` (mm)."""
+        if self.key is None:
+            return
+        with instrument.span('blit'):
+            self._show(self.voxel(coords))
+
+    def _show(self, ijk):
+        self.ijk = ijk
+        for volume, masked, artists in self.layers:
+            for artist, data in zip(artists, _slices(volume, ijk)):
+                artist.set_data(np.ma.masked_equal(data, 0) if masked else data)
+        # (horizontal, vertical) position of the cross in each view: sagittal (j, k), coronal (i, k), axial (i, j)
+        for (vline, hline), (x, y) in zip(self.cross, ((ijk[1], ijk[2]), (ijk[0], ijk[2]), (ijk[0], ijk[1]))):
+            vline.set_xdata([x, x])
+            hline.set_ydata([y, y])
+        if self.background is None:
+            self.canvas.draw()  # grabs the background and blits
+            return
+        self._blit()
+
+    def _blit(self):
+        """Draw the slices and the cross over the background."""
+        self.canvas.restore_region(self.background)
+        for ax, n in zip(self.axes, range(3)):
+            for _, _, artists in self.layers:
+                ax.draw_artist(artists[n])
+            for line in self.cross[n]:
+                ax.draw_artist(line)
+        self.canvas.blit(self.fig.bbox)
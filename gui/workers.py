@@ -0,0 +1,112 @@
+"""
+workers.py
+
+Background threads for the GUI, so that long computations never block the Qt event loop.
+"""
+import threading
+
+from PyQt4 import QtCore
+
+from reports import generate_reports
+
+
+class AnalysisWorker(QtCore.QThread):
+    """
+    Correlates one ICA component with every RSN template off the GUI thread. The score of each template is emitted
+    through `score_ready` as soon as it is computed, and `cancel()` stops the run after the current template.
+    """
+    score_ready = QtCore.pyqtSignal(str, int, float)  # ICA lookup, template column, score
+
+    def __init__(self, mapper, lookup, img, parent=None):
+        super(AnalysisWorker, self).__init__(parent)
+        self.mapper, self.lookup, self.img = mapper, lookup, img
+        self.cancelled = False
+        self.completed = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        scores = self.mapper.iter_scores(self.img, label=self.lookup)
+        for column, score in scores:
+            if self.cancelled:
+                scores.close()  # nothing is stored for a partial component
+                return
+            self.score_ready.emit(self.lookup, column, score[self.mapper.metrics[0]])
+        self.completed = True
+
+
+class PrecomputeWorker(QtCore.QThread):
+    """
+    Correlates every ICA component with the RSN templates in the background, one component at a time, in the order
+    given. `prioritize()` moves a component to the front of the queue (e.g. the one the user just selected), so that
+    clicking through the list finds its scores already computed. Run it with `start(QtCore.QThread.LowPriority)`.
+    The mapper's template bank, if any, is brought up to date on the grid of the first component before it is
+    correlated.
+    """
+    component_ready = QtCore.pyqtSignal(str)  # ICA lookup, its row is in mapper.corr
+
+    def __init__(self, mapper, components, parent=None):
+        super(PrecomputeWorker, self).__init__(parent)
+        self.mapper = mapper
+        self.images = dict(components)
+        self.pending = [lookup for lookup, _ in components]  # queue of ICA lookups, front first
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def prioritize(self, lookup):
+        with self.lock:
+            if lookup in self.pending:
+                self.pending.remove(lookup)
+                self.pending.insert(0, lookup)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _next(self):
+        with self.lock:
+            return self.pending.pop(0) if self.pending else None
+
+    def run(self):
+        lookup = self._next()
+        if lookup is not None and self.mapper.template_bank is not None:  # may resample every template
+            self.mapper.template_bank.masks(self.mapper.map_files, self.images[lookup], threshold=self.mapper.threshold)
+        while lookup is not None and not self.cancelled:
+            if lookup not in self.mapper.corr:  # may have been computed on demand meanwhile
+                self.mapper.run_one(self.images[lookup], label=lookup)
+            self.component_ready.emit(lookup)
+            lookup = self._next()
+
+
+class TimeSeriesWorker(QtCore.QThread):
+    """
+    Maps the fMRI of a `timeseries.TimeSeriesStore` off the GUI thread, converting it first if it cannot be mapped
+    as it is. Other threads asking for the same file meanwhile wait for this conversion instead of starting their own.
+    """
+    def __init__(self, store, parent=None):
+        super(TimeSeriesWorker, self).__init__(parent)
+        self.store = store
+
+    def run(self):
+        self.store.data
+
+
+class ReportWorker(QtCore.QThread):
+    """
+    Writes the reports of the mapped components off the GUI thread. Each job is first passed through `prepare` on
+    this thread (reading the time series may take a while the first time), then the reports whose inputs changed are
+    rendered on a process pool (see `reports.generate_reports`).
+    """
+    progress = QtCore.pyqtSignal(int, int)  # reports done, total
+
+    def __init__(self, jobs, prepare=None, n_jobs=-1, assets_directory=None, parent=None):
+        super(ReportWorker, self).__init__(parent)
+        self.jobs, self.prepare, self.n_jobs = jobs, prepare, n_jobs
+        self.assets_directory = assets_directory
+        self.html_files = []
+
+    def run(self):
+        self.progress.emit(0, len(self.jobs))
+        jobs = [self.prepare(job) for job in self.jobs] if self.prepare is not None else self.jobs
+        self.html_files = generate_reports(jobs, n_jobs=self.n_jobs, progress=self.progress.emit,
+                                           assets_directory=self.assets_directory)
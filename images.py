@@ -0,0 +1,158 @@
+"""
+images.py
+
+Lazy image handles. A `LazyImage` reads only the NIfTI header when it is created; voxel data are read on first use
+and can be dropped again, either explicitly or automatically once the loaded images exceed a memory budget. Voxel
+values are read through `dataobj` as float32 (`voxel_data`), never as float64 copies. Large 4-D files are streamed in
+bounded chunks of volumes by `iter_volume_chunks` instead.
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+from nibabel.nifti1 import Nifti1Image
+from nibabel.openers import ImageOpener
+
+import instrument
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3  # bytes of voxel data kept loaded before the least recently used are released
+
+
+class LazyImage(object):
+    """
+    Handle on a NIfTI file. `shape`, `affine` and `header` are available straight away; `img` returns the
+    `Nifti1Image` (loading its data when first asked for) and `release()` frees the voxel data again. The handles
+    and the record of loaded images may be shared between threads.
+    """
+    _loaded = OrderedDict()  # id -> handle, least recently used first
+    _lock = threading.RLock()  # guards `_loaded` and every handle's image; reentrant for `_enforce_budget`
+    memory_budget = DEFAULT_MEMORY_BUDGET
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        proxy = nib.load(file_name)  # nibabel only parses the header here, the data stay on disk
+        self.header, self.affine, self.shape = proxy.header, proxy.affine, proxy.shape
+        self._img = None
+
+    @property
+    def nbytes(self):
+        """In-memory size of the (float32) voxel data."""
+        return int(np.prod(self.shape)) * 4
+
+    @property
+    def loaded(self):
+        return self._img is not None
+
+    @property
+    def img(self):
+        with LazyImage._lock:
+            if self._img is None:
+                self._img = _load_img(self.file_name)  # header and data proxy; voxels are read by `voxel_data`
+                LazyImage._loaded[id(self)] = self
+                LazyImage._enforce_budget(keep=self)
+            else:
+                LazyImage._loaded[id(self)] = LazyImage._loaded.pop(id(self), self)  # mark as most recently used
+            return self._img
+
+    def get_data(self):
+        """float32 voxel values, kept until the image is released (see `voxel_data`)."""
+        return voxel_data(self.img)
+
+    def release(self):
+        """Drop the loaded image; the next access reads it from disk again."""
+        with LazyImage._lock:
+            if self._img is not None:
+                self._img.uncache()
+                self._img = None
+            LazyImage._loaded.pop(id(self), None)
+
+    @classmethod
+    def _enforce_budget(cls, keep=None):
+        with cls._lock:
+            total = sum(h.nbytes for h in cls._loaded.values())
+            for handle in list(cls._loaded.values()):
+                if total <= cls.memory_budget:
+                    break
+                if handle is not keep:
+                    total -= handle.nbytes
+                    handle.release()
+
+    @classmethod
+    def set_memory_budget(cls, n_bytes):
+        with cls._lock:
+            cls.memory_budget = n_bytes
+            cls._enforce_budget()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.file_name)
+
+
+def _load_img(file_name):
+    from nilearn import image  # importing nilearn is slow; only pay for it once an image is actually read
+    return image.load_img(file_name)
+
+
+def as_img(img):
+    """`Nifti1Image` for a file path, a `LazyImage` or an image (returned unchanged)."""
+    if isinstance(img, LazyImage):
+        return img.img
+    return img if isinstance(img, Nifti1Image) else _load_img(img)
+
+
+def voxel_data(img, cache=True):
+    """
+    Voxel values of a path, `LazyImage` or image as a float32 array of the image's shape, scaled straight into float32
+    from `dataobj`. With `cache` the array is kept by the image (until released) and must not be modified; volumes
+    read once, like components being mapped, are better read without.
+    """
+    img = as_img(img)
+    caching = 'fill' if cache else 'unchanged'
+    file_name = img.get_filename()
+    if img.in_memory or not file_name:
+        return img.get_fdata(dtype=np.float32, caching=caching)
+    with instrument.span('load', file=file_name):
+        data = img.get_fdata(dtype=np.float32, caching=caching)
+    instrument.count('bytes_read', os.path.getsize(file_name))  # as stored, i.e. compressed for .nii.gz
+    return data
+
+
+def is_image(obj):
+    """True for the image types accepted by `as_img` other than paths."""
+    return isinstance(obj, (Nifti1Image, LazyImage))
+
+
+def image_path(img):
+    """File path behind a path or `LazyImage`, None for images held only in memory."""
+    if isinstance(img, LazyImage):
+        return img.file_name
+    return img if isinstance(img, str) else None
+
+
+def image_identity(img):
+    """Absolute file path behind a path or `LazyImage`, or the id() of an image held only in memory."""
+    path = image_path(img)
+    return os.path.abspath(path) if path is not None else id(img)
+
+
+def iter_volume_chunks(file_name, max_bytes=256 * 1024 ** 2):
+    """
+    Stream a 4-D NIfTI file as (first volume, float32 array of shape (x, y, z, n)) chunks of at most `max_bytes`,
+    reading the file front to back exactly once, so that compressed files of any size never have to fit in memory.
+    """
+    proxy = nib.load(file_name).dataobj  # header only: shape, dtype, offset and scaling of the data on disk
+    shape = proxy.shape if len(proxy.shape) > 3 else proxy.shape + (1,)
+    dtype, slope, inter = proxy.dtype, float(proxy.slope), float(proxy.inter)
+    volume_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+    n_per_chunk = max(1, min(shape[3], max_bytes // max(volume_bytes, 1)))
+    with ImageOpener(file_name, 'rb') as f:
+        f.seek(proxy.offset)
+        for start in range(0, shape[3], n_per_chunk):
+            n = min(n_per_chunk, shape[3] - start)
+            raw = np.frombuffer(f.read(n * volume_bytes), dtype=dtype)
+            instrument.count('bytes_read', raw.nbytes)
+            chunk = raw.reshape(shape[:3] + (n,), order='F').astype(np.float32)  # NIfTI data are Fortran ordered
+            if slope != 1. or inter != 0.:
+                chunk *= slope
+                chunk += inter
+            yield start, chunk
@@ -0,0 +1,142 @@
+"""
+instrument.py
+
+Lightweight timing spans and counters for the hot paths (image load, resample, binarize, correlate, contour, render,
+encode, write; cache hits, bytes read). Disabled by default, in which case `span()` returns a shared no-op context
+manager and `count()` returns straight away; enable it with `enable()` or the ICA_MAPPING_TRACE environment variable.
+Recorded spans can be summarized, exported as JSON or as a Chrome trace (chrome://tracing, Perfetto). Only the most
+recent `MAX_EVENTS` spans are kept for export, while the summary covers every span since the last reset.
+
+    with instrument.span('resample', file=name):
+        ...
+    instrument.count('template_cache.hits')
+"""
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+
+MAX_EVENTS = 100000
+_enabled = bool(os.environ.get('ICA_MAPPING_TRACE'))
+_lock = threading.Lock()
+_events = deque(maxlen=MAX_EVENTS)  # (name, start, duration, thread id, args)
+_totals = {}  # name -> {'count', 'total_s', 'max_s'} of every span
+_counters = defaultdict(int)
+_origin = time.time()
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name, self.args = name, args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.start
+        with _lock:
+            _events.append((self.name, self.start, duration, threading.current_thread().ident, self.args))
+            t = _totals.setdefault(self.name, {'count': 0, 'total_s': 0., 'max_s': 0.})
+            t['count'] += 1
+            t['total_s'] += duration
+            t['max_s'] = max(t['max_s'], duration)
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """Forget every recorded span and counter."""
+    global _origin
+    with _lock:
+        _events.clear()
+        _totals.clear()
+        _counters.clear()
+        _origin = time.time()
+
+
+def span(name, **args):
+    """Context manager timing the block under `name`; `args` are kept with the span (e.g. the file name)."""
+    return _Span(name, args) if _enabled else _NULL_SPAN
+
+
+def count(name, n=1):
+    """Add `n` to the counter `name`."""
+    if _enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def summary():
+    """{span name: {'count', 'total_s', 'max_s'}} over all recorded spans."""
+    with _lock:
+        return dict((name, dict(t)) for name, t in _totals.items())
+
+
+def status_line(max_items=4):
+    """Short text of the slowest spans and the cache counters, for a status bar."""
+    spans = sorted(summary().items(), key=lambda item: -item[1]['total_s'])[:max_items]
+    parts = ['%s %.2f s (%d)' % (name, t['total_s'], t['count']) for name, t in spans]
+    c = counters()
+    for cache in sorted(set(k.rsplit('.', 1)[0] for k in c if k.endswith('.hits') or k.endswith('.misses'))):
+        hits, misses = c.get(cache + '.hits', 0), c.get(cache + '.misses', 0)
+        parts.append('%s %d/%d hits' % (cache, hits, hits + misses))
+    if 'bytes_read' in c:
+        parts.append('%.1f MB read' % (c['bytes_read'] / 1024. ** 2))
+    return ' | '.join(parts)
+
+
+def export_json(file_name):
+    """Spans (start relative to the last reset), their summary and the counters as JSON."""
+    with _lock:
+        events = [{'name': name, 'start_s': start - _origin, 'duration_s': duration, 'thread': tid, 'args': args}
+                  for name, start, duration, tid, args in _events]
+    with open(file_name, 'w') as f:
+        json.dump({'spans': events, 'summary': summary(), 'counters': counters()}, f, indent=2, sort_keys=True,
+                  default=str)
+
+
+def export_chrome_trace(file_name):
+    """Spans as complete ('X') events and the final counter values as counter ('C') events of the Chrome trace format."""
+    pid = os.getpid()
+    with _lock:
+        trace = [{'name': name, 'ph': 'X', 'ts': (start - _origin) * 1e6, 'dur': duration * 1e6, 'pid': pid,
+                  'tid': tid, 'args': dict((k, str(v)) for k, v in args.items())}
+                 for name, start, duration, tid, args in _events]
+        end = max([e['ts'] + e['dur'] for e in trace] or [0.])
+        trace += [{'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {'value': value}}
+                  for name, value in _counters.items()]
+    with open(file_name, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
@@ -1,8 +1,101 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
 import numpy as np
-from sklearn import svm, linear_model as lin, metrics
-from nilearn import image
-from nibabel.nifti1 import Nifti1Image
-import nipype.interfaces.spm.utils as spm
+from masks import PackedMasks, SparseMasks, binarize
+from images import LazyImage, as_img, is_image, image_path, voxel_data
+import similarity
+import instrument
+# nilearn is imported where it is needed: it (and the scipy/sklearn stack behind it) costs more import time than
+# everything else, and the template bank or cache usually make resampling unnecessary
+
+
+DEFAULT_TEMPLATE_CACHE_BYTES = 1024 ** 3  # prepared templates kept before the least recently used are dropped
+
+
+class TemplateCache(object):
+    """
+    LRU store, bounded to `max_bytes`, of templates that have been resampled onto a target grid and binarized and
+    bit-packed (see `masks.PackedMasks`) or reduced to their sorted voxel indices (sparse), or kept as float32 values
+    for a threshold of None. Every component of one melodic run shares the same grid, so each template only has to be
+    resampled once per run rather than once per component. Entries are keyed on (template identity, target affine,
+    target shape, threshold, representation), where a template file is identified by its path, size and mtime, so
+    that a file rewritten in place is prepared again. A cache may be shared between threads; a template asked for by
+    two threads at once may be prepared twice, but is stored once.
+    """
+    def __init__(self, max_bytes=DEFAULT_TEMPLATE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()  # guards `_items` and the counters; templates are prepared outside it
+
+    @staticmethod
+    def key(template, reference, threshold, sparse=False):
+        # in-memory images are identified by id(); the entry keeps a reference so the id cannot be recycled
+        path = image_path(template)
+        if path is not None:
+            st = os.stat(path)
+            identity = os.path.abspath(path), st.st_size, st.st_mtime
+        else:
+            identity = id(template)
+        return identity, reference.affine.tobytes(), tuple(reference.shape[:3]), threshold, sparse
+
+    def get(self, template, reference, threshold=0.5, sparse=False):
+        """
+        Bit-packed binary mask of `template` on the grid of `reference`; its sorted voxel indices with `sparse`, or
+        its values for `threshold=None`.
+        """
+        key = TemplateCache.key(template, reference, threshold, sparse=sparse)
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items[key] = self._items.pop(key)  # mark as most recently used
+                dat = self._items[key][1]
+            else:
+                self.misses += 1
+                dat = None
+        if dat is not None:
+            instrument.count('template_cache.hits')
+            return dat
+        instrument.count('template_cache.misses')
+        if threshold is None:
+            dat = Mapper.prep_values(template, reference=reference)
+            dat.flags.writeable = False  # shared between callers
+        elif sparse:
+            dat = np.flatnonzero(Mapper.prep_tmap(template, reference=reference, threshold=threshold)).astype(np.int32)
+            dat.flags.writeable = False
+        else:
+            dat = PackedMasks.from_dense(Mapper.prep_tmap(template, reference=reference, threshold=threshold))
+            dat.words.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            self._nbytes -= old[1].nbytes if old is not None else 0
+            self._items[key] = (template, dat)
+            self._nbytes += dat.nbytes
+            while self._nbytes > self.max_bytes and len(self._items) > 1:
+                self._nbytes -= self._items.popitem(last=False)[1][1].nbytes  # evict least recently used
+        return dat
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+            self.hits, self.misses = 0, 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._items)
+
+
+TEMPLATE_CACHE = TemplateCache()  # shared by all mappers unless one is given its own
+MIN_BLOCK_WORDS = 64  # narrowest voxel block of a tile (in 64-voxel words); narrower ones cost more than they save
 
 
 class Mapper(object):
@@ -11,30 +104,97 @@ class Mapper(object):
     Correlation Coeficient (Phi-correlation coefficient), which is useful for binary vector correlations. Similar in
     interpretation to the Pearson Coefficient, this value ranges from -1 to 1, were -1 implies a anti-correlation,
     0 implies no correlation at at, and 1 is a perfect positive correlation.
+
+    Further `metrics` (see `similarity`: dice, jaccard, overlap, pearson) are computed in the same pass; `scores` holds
+    every metric per component, while `corr` holds the first metric, which drives the ranking.
+
+    With a `memory_budget` (bytes) the comparison is tiled over blocks of components and of voxels sized to stay
+    within it (see `tile_shape`), for high-resolution grids with many components and templates. `memory_workers` is
+    the number of processes sharing that budget, e.g. the subjects of a batch mapped at the same time.
     """
-    def __init__(self, map_files, in_files=None, threshold=0.5):
+    def __init__(self, map_files, in_files=None, threshold=0.5, template_cache=None, template_bank=None,
+                 metrics=('phi',), sparse_templates=False, memory_budget=None, memory_workers=1):
         self.in_files, self.map_files, self.threshold = in_files, map_files, threshold
+        self.sparse_templates = sparse_templates  # store templates as voxel indices; pays off for small parcels
+        self.memory_budget, self.memory_workers = memory_budget, memory_workers
+        self.metrics = similarity.check_metrics(metrics)
+        self.template_cache = template_cache if template_cache is not None else TEMPLATE_CACHE
+        self.template_bank = template_bank  # template_bank.TemplateBank; requires `map_files` to be files
         self.corr = {}
+        self.scores = {m: {} for m in self.metrics}
         self.matches = {}
         self._load_files()
 
     def _load_files(self):
         self.corr = {}
-        self.in_imgs = [i if isinstance(i, Nifti1Image) else image.load_img(i) for i in self.in_files]
-        self.map_imgs = [i if isinstance(i, Nifti1Image) else image.load_img(i) for i in self.map_files]
+        self.scores = {m: {} for m in self.metrics}
+        # file paths become lazy handles: only headers are read here, voxel data when a map is first binarized
+        self.in_imgs = [i if is_image(i) else LazyImage(i) for i in self.in_files]
+        self.map_imgs = [i if is_image(i) else LazyImage(i) for i in self.map_files]
 
-    def run(self):
-        """Generate correlations, find top matches, choose best fit"""
-        self.corr = {self.in_files[i]: Mapper.spatial_correlations(self.in_imgs[i], self) for i in range(len(self.in_files))}
+    def run(self, n_jobs=1):
+        """
+        Generate correlations of every `in_files` image against all templates. With `n_jobs` other than 1 the
+        components are spread over a pool of worker processes (-1 uses every core); results are merged into `corr`.
+        """
+        if n_jobs == 1:
+            scores = Mapper.similarities(self.in_imgs, self.map_imgs, metrics=self.metrics, threshold=self.threshold,
+                                         cache=self.template_cache, bank=self.template_bank,
+                                         sparse=self.sparse_templates, memory_budget=self.memory_budget,
+                                         memory_workers=self.memory_workers)
+        else:
+            memory_budget = self.memory_budget // self.memory_workers if self.memory_budget is not None else None
+            scores = Mapper.parallel_similarities(self.in_files, self.map_imgs, metrics=self.metrics,
+                                                  threshold=self.threshold, cache=self.template_cache,
+                                                  bank=self.template_bank, sparse=self.sparse_templates,
+                                                  n_jobs=n_jobs, memory_budget=memory_budget)
+        self._store_scores(self.in_files, scores)
+        return self.corr
 
     def run_one(self, in_file, label=None):
         label = label if label else in_file
-        corr = Mapper.spatial_correlations(in_file, self.map_imgs)
-        self.corr.update({label: corr[0]})
-        return corr
+        scores = Mapper.similarities(in_file, self.map_imgs, metrics=self.metrics, threshold=self.threshold,
+                                     cache=self.template_cache, bank=self.template_bank, sparse=self.sparse_templates)
+        self._store_scores([label], scores)
+        return scores[self.metrics[0]]
+
+    def _store_scores(self, labels, scores):
+        for metric in self.metrics:
+            self.scores[metric].update({label: scores[metric][i] for i, label in enumerate(labels)})
+        self.corr.update({label: scores[self.metrics[0]][i] for i, label in enumerate(labels)})
+
+    def iter_scores(self, in_file, label=None):
+        """
+        Generator over (template index, {metric: score}) for one component, computed template by template so that
+        callers can show each result as it arrives and stop early. Once every template is done the row is stored in
+        `scores` and `corr` as by `run_one`; a generator closed before that stores nothing.
+        """
+        label = label if label else in_file
+        img = in_file if is_image(in_file) else LazyImage(in_file)
+        continuous = any(m in similarity.CONTINUOUS_METRICS for m in self.metrics)
+        img_arr, values = Mapper._component_data([img], self.threshold, continuous=continuous)
+        row = {m: np.zeros((1, len(self.map_imgs))) for m in self.metrics}
+        for j, mimg in enumerate(self.map_imgs):
+            map_arr = Mapper.template_masks([mimg], img, threshold=self.threshold, cache=self.template_cache,
+                                            bank=self.template_bank, sparse=self.sparse_templates)
+            map_values = Mapper.template_values([mimg], img, cache=self.template_cache) if continuous else None
+            scores = Mapper._scores(img_arr, values, map_arr, map_values, self.metrics)
+            for metric in self.metrics:
+                row[metric][0, j] = scores[metric][0, 0]
+            yield j, {metric: row[metric][0, j] for metric in self.metrics}
+        self._store_scores([label], row)
+
+    def threshold_sweep(self, thresholds=(0.5, 1., 1.5, 2., 2.5, 3.)):
+        """
+        Correlations of every `in_files` image with every template over a range of component `thresholds` (the
+        templates stay binarized at `threshold`). Returns an (n_components, n_templates, n_thresholds) array.
+        """
+        return Mapper.threshold_sweep_correlations(self.in_imgs, self.map_imgs, thresholds,
+                                                   template_threshold=self.threshold, cache=self.template_cache,
+                                                   bank=self.template_bank)
 
     def get_top_matches(self, in_file, num_matches=None, minimum_corr=None):
-        corr = self.corr[in_file] if in_file in self.corr.keys() else self.spatial_correlations(image.load_img(in_file))
+        corr = self.corr[in_file] if in_file in self.corr.keys() else self.spatial_correlations(as_img(in_file))
         ordered = np.argsort(corr)[::-1]  # sort lowest to highest, then reverse ([::-1])
         if not type(num_matches, 'int'):
             ordered = ordered[:num_matches]
@@ -45,30 +205,380 @@ class Mapper(object):
         for i, img in enumerate(self.in_imgs):
             top_map_idx = np.argmax(self.corr[self.in_files[i]])
             if self.corr[self.in_files[i]][top_map_idx] >= minimum_correlation:
-                self.matches[self.in_files[i]] = self.map_files[i]
+                self.matches[self.in_files[i]] = self.map_files[top_map_idx]
             else:
                 self.matches[self.in_files[i]] = null_network
         return self.matches
 
     @staticmethod
     def prep_tmap(img, reference=None, threshold=0.5):
-        img = img if isinstance(img, Nifti1Image) else image.load_img(img)
-        if isinstance(reference, (str, Nifti1Image)):
-            dat = image.resample_to_img(source_img=img, target_img=reference).get_data().flatten()
+        """Binary mask |img| >= `threshold` (resampled to `reference` if given) as a flat bool vector."""
+        img = as_img(img)
+        if isinstance(reference, str) or is_image(reference):
+            from nilearn import image
+            with instrument.span('resample'):
+                img = image.resample_to_img(source_img=img, target_img=as_img(reference))
+        with instrument.span('binarize'):
+            return binarize(voxel_data(img, cache=False), threshold).ravel()  # only the bool mask is flattened (copied)
+
+    @staticmethod
+    def prep_values(img, reference=None):
+        """Voxel values of `img` (resampled to `reference` if given) as a flat float32 vector."""
+        img = as_img(img)
+        if isinstance(reference, str) or is_image(reference):
+            from nilearn import image
+            with instrument.span('resample'):
+                img = image.resample_to_img(source_img=img, target_img=as_img(reference))
+        return voxel_data(img, cache=False).ravel()
+
+    @staticmethod
+    def phi_matrix(x, y):
+        """
+        Phi-correlation of every mask in `x` with every mask in `y`. Both are `PackedMasks` or binary matrices of shape
+        (n_masks, n_voxels). All four confusion counts follow from the pairwise overlaps (bitwise AND plus popcount)
+        and the number of voxels set in each mask, so no per-pair confusion matrix is ever built.
+        """
+        x = x if isinstance(x, PackedMasks) else PackedMasks.from_dense(x)
+        y = y if isinstance(y, PackedMasks) else PackedMasks.from_dense(y)
+        return Mapper.phi_from_counts(x.overlap(y), x.counts(), y.counts(), x.n_voxels)
+
+    @staticmethod
+    def phi_from_counts(tp, x_sum, y_sum, n):
+        """
+        Phi-correlation from the overlap counts `tp` (n_x, n_y), the number of positives in each row of `x` and `y`,
+        and the number of voxels `n` (see `similarity.phi`).
+        """
+        return similarity.phi(tp, x_sum, y_sum, n)
+
+    @staticmethod
+    def template_masks(map_imgs, reference, threshold=0.5, cache=TEMPLATE_CACHE, bank=None, sparse=False):
+        """
+        `PackedMasks` (or with `sparse`, `SparseMasks`) of the `map_imgs` templates on the grid of `reference`. They are
+        read from the on-disk `bank` if one is given (`map_imgs` must then be files), else taken from `cache` when
+        possible (pass `cache=None` to always resample).
+        """
+        if bank is not None:
+            packed = bank.masks(map_imgs, reference, threshold=threshold)
+            return SparseMasks.from_packed(packed) if sparse else packed
+        if sparse:
+            n_voxels = int(np.prod(reference.shape[:3]))
+            if cache is not None:
+                return SparseMasks.from_indices([cache.get(mimg, reference, threshold=threshold, sparse=True)
+                                                 for mimg in map_imgs], n_voxels)
+            return SparseMasks.from_dense(np.vstack([Mapper.prep_tmap(mimg, reference=reference, threshold=threshold)
+                                                     for mimg in map_imgs]))
+        if cache is not None:
+            return PackedMasks.stack([cache.get(mimg, reference, threshold=threshold) for mimg in map_imgs])
+        return PackedMasks.stack([PackedMasks.from_dense(Mapper.prep_tmap(mimg, reference=reference,
+                                                                          threshold=threshold))
+                                  for mimg in map_imgs])
+
+    @staticmethod
+    def _group_by_grid(imgs):
+        """Indices of the `imgs` sharing each grid (shape and affine), in order of first appearance."""
+        grids = OrderedDict()
+        for i, img in enumerate(imgs):
+            grids.setdefault((img.shape[:3], img.affine.tobytes()), []).append(i)
+        return list(grids.values())
+
+    @staticmethod
+    def template_values(map_imgs, reference, cache=TEMPLATE_CACHE, stack=True):
+        """
+        (n_maps, n_voxels) float32 values of the unthresholded templates on the grid of `reference`, or without
+        `stack` the list of their rows (no stacked copy).
+        """
+        if cache is not None:
+            rows = [cache.get(mimg, reference, threshold=None) for mimg in map_imgs]
         else:
-            dat = img.get_data().flatten()
-        dat[np.abs(dat) >= threshold] = 1.
-        dat[np.abs(dat) < threshold] = 0.
-        return dat
+            rows = [Mapper.prep_values(mimg, reference=reference) for mimg in map_imgs]
+        return np.vstack(rows) if stack else rows
+
+    @staticmethod
+    def _block_similarities(imgs, map_arr, map_values, metrics, threshold):
+        """
+        Every metric for a block of component images on one grid, against the templates prepared for that grid
+        (`map_values` is only needed for continuous metrics). Each component is read once; the binary metrics share
+        one set of overlap counts and the continuous ones one stacked matrix.
+        """
+        img_arr, values = Mapper._component_data(imgs, threshold, continuous=map_values is not None)
+        return Mapper._scores(img_arr, values, map_arr, map_values, metrics)
+
+    @staticmethod
+    def _component_data(imgs, threshold, continuous=False, release=False):
+        """
+        Packed masks of the `imgs` and, if `continuous`, their stacked float32 values; each image is read once. With
+        `release`, lazy images that were not loaded before drop their voxel data again once read.
+        """
+        masks, values = [], None
+        for i, img in enumerate(imgs):
+            was_loaded = not isinstance(img, LazyImage) or img.loaded
+            dat = voxel_data(img, cache=False)
+            with instrument.span('binarize'):
+                masks.append(PackedMasks.from_dense(binarize(dat, threshold).ravel()))  # same voxels as prep_tmap
+            if continuous:
+                if values is None:
+                    values = np.empty((len(imgs), dat.size), dtype=np.float32)
+                values[i].reshape(dat.shape)[...] = dat  # in C order like ravel(), without a temporary
+            del dat
+            if release and not was_loaded:
+                img.release()
+        return PackedMasks.stack(masks), values
+
+    @staticmethod
+    def _scores(img_arr, values, map_arr, map_values, metrics):
+        """Every metric from prepared components and templates: one set of overlap counts for all binary metrics."""
+        with instrument.span('correlate', components=len(img_arr), templates=len(map_arr)):
+            return Mapper._compute_scores(img_arr, values, map_arr, map_values, metrics)
+
+    @staticmethod
+    def _compute_scores(img_arr, values, map_arr, map_values, metrics):
+        scores = {}
+        binary = [m for m in metrics if m in similarity.BINARY_METRICS]
+        if binary:
+            tp = img_arr.overlap(map_arr)
+            for metric in binary:
+                scores[metric] = similarity.BINARY_METRICS[metric](tp, img_arr.counts(), map_arr.counts(),
+                                                                   map_arr.n_voxels)
+        for metric in metrics:
+            if metric in similarity.CONTINUOUS_METRICS:
+                scores[metric] = similarity.CONTINUOUS_METRICS[metric](values, map_values)
+        return scores
+
+    @staticmethod
+    def tile_shape(n_components, n_maps, n_voxels, memory_budget, continuous=False, n_workers=1, shared=False):
+        """
+        (components per block, voxels per block) for `tiled_similarities` within `memory_budget` bytes, the total of
+        `n_workers` processes comparing components at the same time. The budget covers the templates as held during
+        the comparison (their packed masks and, for `continuous` metrics, their float32 values; counted once if they
+        are memory-mapped files `shared` by the workers, else once per worker) and, per worker, the component being
+        read, the block of prepared components and the temporaries of one tile; of what a worker has left after the
+        templates and the component being read, up to half goes to the block of components. Voxel blocks are whole
+        64-voxel words, at least `MIN_BLOCK_WORDS` of them. Raises ValueError if the budget cannot hold one component
+        and the narrowest block in every worker, naming the smallest budget that can.
+        """
+        n_words = -(-n_voxels // 64)
+        templates = n_maps * n_words * 8 + (n_maps * n_voxels * 4 if continuous else 0)
+        resident = 0 if shared else templates  # per worker
+        reading = n_voxels * 14  # the component being read: file buffers, float32 data and the binary masks
+        per_component = n_words * 8 + (n_voxels * 4 if continuous else 0)
+        per_word = n_maps * 16 + (n_maps * 64 * 8 if continuous else 0)  # AND and popcount, template values
+        per_word_component = 64 * 8 if continuous else 0  # component values of the tile
+        min_words = min(n_words, MIN_BLOCK_WORDS)
+        minimum = (templates if shared else 0) + \
+            n_workers * (resident + reading + per_component + min_words * (per_word + per_word_component))
+        if memory_budget < minimum:
+            raise ValueError('A memory budget of %.1f MB is too small for %d templates of %d voxels%s; at least %.1f '
+                             'MB is needed' % (memory_budget / 1024. ** 2, n_maps, n_voxels,
+                                               ' in %d workers' % n_workers if n_workers > 1 else '',
+                                               np.ceil(minimum / 1024. ** 2 * 10) / 10))
+        available = (memory_budget - (templates if shared else 0)) // n_workers - resident - reading
+        n_components_block = min(n_components, available // 2 // per_component,
+                                 (available - min_words * per_word) // (per_component + min_words * per_word_component))
+        n_components_block = int(max(1, n_components_block))
+        available -= n_components_block * per_component
+        n_words_block = available // (per_word + n_components_block * per_word_component)
+        n_words_block = int(max(min_words, min(n_words, n_words_block)))
+        return n_components_block, min(n_voxels, n_words_block * 64)
+
+    @staticmethod
+    def _is_mapped(arr):
+        """True if `arr` is a memory map of a file, which processes mapping the same file share."""
+        return isinstance(arr, np.memmap) and bool(arr.filename)
+
+    @staticmethod
+    def shared_templates(map_arr, map_values):
+        """True if the templates (and their values, if any) are memory-mapped files, see `tile_shape`."""
+        arr = map_arr.indices if isinstance(map_arr, SparseMasks) else map_arr.words
+        return Mapper._is_mapped(arr) and (map_values is None or Mapper._is_mapped(map_values))
+
+    @staticmethod
+    def tiled_similarities(imgs, map_arr, map_values, metrics, threshold, memory_budget, n_workers=1):
+        """
+        Same result as `_block_similarities` for components on one grid, with a bounded working set: the components
+        are prepared one block at a time and compared with the templates one block of voxels at a time, adding up the
+        partial overlap counts (and, for continuous metrics, the partial moments, see `similarity.CONTINUOUS_PARTS`)
+        of every tile. `map_values` may be a list of rows (see `template_values`). See `tile_shape` for what
+        `memory_budget`, shared by `n_workers` processes, covers; the scores and the image headers are not counted.
+        """
+        continuous = [m for m in metrics if m in similarity.CONTINUOUS_METRICS]
+        binary = [m for m in metrics if m in similarity.BINARY_METRICS]
+        n_voxels = map_arr.n_voxels
+        n_block, n_voxels_block = Mapper.tile_shape(len(imgs), len(map_arr), n_voxels, memory_budget,
+                                                    continuous=bool(continuous), n_workers=n_workers,
+                                                    shared=Mapper.shared_templates(map_arr, map_values))
+        scores = {m: np.zeros((len(imgs), len(map_arr))) for m in metrics}
+        if continuous:
+            y_mean = np.array([np.mean(v, dtype=np.float64) for v in map_values])
+        for start in range(0, len(imgs), n_block):
+            img_arr, values = Mapper._component_data(imgs[start:start + n_block], threshold,
+                                                     continuous=bool(continuous), release=True)
+            rows = slice(start, start + len(img_arr))
+            tp, x_sum, y_sum = 0, 0, 0
+            parts = dict((m, None) for m in continuous)
+            if continuous:
+                x_mean = values.mean(axis=1, dtype=np.float64)
+            with instrument.span('correlate', components=len(img_arr), templates=len(map_arr)):
+                for v in range(0, n_voxels, n_voxels_block):
+                    if binary:
+                        x, y = img_arr.columns(v, v + n_voxels_block), map_arr.columns(v, v + n_voxels_block)
+                        tp, x_sum, y_sum = tp + x.overlap(y), x_sum + x.counts(), y_sum + y.counts()
+                    if continuous:
+                        y_block = np.vstack([m[v:v + n_voxels_block] for m in map_values])
+                        for metric in continuous:
+                            block = similarity.CONTINUOUS_PARTS[metric][0](values[:, v:v + n_voxels_block], y_block,
+                                                                           x_mean, y_mean)
+                            parts[metric] = block if parts[metric] is None else \
+                                tuple(a + b for a, b in zip(parts[metric], block))
+                for metric in binary:
+                    scores[metric][rows] = similarity.BINARY_METRICS[metric](tp, x_sum, y_sum, n_voxels)
+                for metric in continuous:
+                    scores[metric][rows] = similarity.CONTINUOUS_PARTS[metric][1](parts[metric])
+        return scores
 
     @staticmethod
-    def spatial_correlations(imgs, map_imgs):
-        """Rank the `imgs` against each `map_files` templates."""
-        corr = []
+    def similarities(imgs, map_imgs, metrics=('phi',), threshold=0.5, cache=TEMPLATE_CACHE, bank=None, sparse=False,
+                     memory_budget=None, memory_workers=1):
+        """
+        Compare the `imgs` with each of the `map_imgs` templates under every one of the `metrics`. Images sharing a
+        grid (shape and affine) are processed in one batch against the templates resampled to that grid (see
+        `template_masks`; `sparse` stores them as voxel indices), tiled within `memory_budget` bytes if one is given,
+        of which this process has a `memory_workers`-th (see `tiled_similarities`). Returns a dict of metric ->
+        (n_imgs, n_maps) array.
+        """
         imgs = imgs if hasattr(imgs, '__iter__') else [imgs]  # make iterable
         map_imgs = map_imgs if hasattr(map_imgs, '__iter__') else [map_imgs]  # make iterable
-        for img in imgs:
-            img_arr = Mapper.prep_tmap(img)
-            corr.append([metrics.matthews_corrcoef(Mapper.prep_tmap(mimg, reference=img), img_arr)
-                         for i, mimg in enumerate(map_imgs)])
+        metrics = similarity.check_metrics(metrics)
+        imgs = [img if is_image(img) else LazyImage(img) for img in imgs]
+        scores = {m: np.zeros((len(imgs), len(map_imgs))) for m in metrics}
+        for idx in Mapper._group_by_grid(imgs):
+            map_arr = Mapper.template_masks(map_imgs, imgs[idx[0]], threshold=threshold, cache=cache, bank=bank,
+                                            sparse=sparse)
+            map_values = Mapper.template_values(map_imgs, imgs[idx[0]], cache=cache, stack=memory_budget is None) \
+                if any(m in similarity.CONTINUOUS_METRICS for m in metrics) else None
+            if memory_budget is None:
+                block = Mapper._block_similarities([imgs[i] for i in idx], map_arr, map_values, metrics, threshold)
+            else:
+                block = Mapper.tiled_similarities([imgs[i] for i in idx], map_arr, map_values, metrics, threshold,
+                                                  memory_budget, n_workers=memory_workers)
+            for metric in metrics:
+                scores[metric][idx] = block[metric]
+        return scores
+
+    @staticmethod
+    def spatial_correlations(imgs, map_imgs, threshold=0.5, cache=TEMPLATE_CACHE, bank=None, sparse=False):
+        """
+        Rank the `imgs` against each `map_files` templates by phi-correlation (see `similarities`). Returns an
+        (n_imgs, n_maps) array.
+        """
+        return Mapper.similarities(imgs, map_imgs, metrics=('phi',), threshold=threshold, cache=cache, bank=bank,
+                                   sparse=sparse)['phi']
+
+    @staticmethod
+    def threshold_sweep_correlations(imgs, map_imgs, thresholds, template_threshold=0.5, cache=TEMPLATE_CACHE,
+                                     bank=None):
+        """
+        Phi-correlation of each of the `imgs` binarized at every one of the `thresholds` against each template, in a
+        single pass per component. The voxels are ranked by |value| once; a threshold then keeps the first k ranks, so
+        the overlap with a template is the number of its voxels ranked below k, read off the sorted ranks of the
+        template voxels with one `searchsorted`. NaN voxels are never set. Returns an (n_imgs, n_maps, n_thresholds)
+        array.
+        """
+        imgs = imgs if hasattr(imgs, '__iter__') else [imgs]  # make iterable
+        map_imgs = map_imgs if hasattr(map_imgs, '__iter__') else [map_imgs]  # make iterable
+        imgs = [img if is_image(img) else LazyImage(img) for img in imgs]
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        corr = np.zeros((len(imgs), len(map_imgs), len(thresholds)))
+        for idx in Mapper._group_by_grid(imgs):
+            map_arr = Mapper.template_masks(map_imgs, imgs[idx[0]], threshold=template_threshold, cache=cache,
+                                            bank=bank, sparse=True)
+            map_voxels = [map_arr.row(j) for j in range(len(map_arr))]
+            for i in idx:
+                dat = np.abs(voxel_data(imgs[i], cache=False)).ravel()
+                dat[np.isnan(dat)] = -np.inf  # ranked last and below every threshold: never set, as in `binarize`
+                order = np.argsort(-dat, kind='mergesort')  # strongest voxel first
+                rank = np.empty(dat.size, dtype=np.int64)
+                rank[order] = np.arange(dat.size)
+                n_above = np.searchsorted(-dat[order], -thresholds, side='right')  # voxels >= threshold
+                tp = np.column_stack([np.searchsorted(np.sort(rank[v]), n_above) for v in map_voxels])
+                corr[i] = Mapper.phi_from_counts(tp, n_above, map_arr.counts(), map_arr.n_voxels).T
         return corr
+
+    @staticmethod
+    def _is_whole_npy(arr):
+        """True if `arr` is a memory map of a complete `.npy` file (not a slice of one)."""
+        return isinstance(arr, np.memmap) and bool(arr.filename) and arr.filename.endswith('.npy') and \
+            np.load(arr.filename, mmap_mode='r').shape == arr.shape
+
+    @staticmethod
+    def parallel_similarities(imgs, map_imgs, metrics=('phi',), threshold=0.5, cache=TEMPLATE_CACHE, bank=None,
+                              sparse=False, n_jobs=-1, memory_budget=None):
+        """
+        Same result as `similarities`, with the components split over `n_jobs` worker processes. The templates of
+        each grid are handed to the workers as memory-mapped `.npy` files (the bank file itself when possible)
+        instead of being pickled into every task; pass the `imgs` as file paths to keep the tasks small. A
+        `memory_budget` is the total of all workers, which share the template files (see `tile_shape`); it is checked
+        for every grid before any worker starts.
+        """
+        imgs = imgs if hasattr(imgs, '__iter__') else [imgs]  # make iterable
+        map_imgs = map_imgs if hasattr(map_imgs, '__iter__') else [map_imgs]  # make iterable
+        metrics = similarity.check_metrics(metrics)
+        n_jobs = cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+        headers = [img if is_image(img) else LazyImage(img) for img in imgs]
+        scores = {m: np.zeros((len(imgs), len(map_imgs))) for m in metrics}
+        grids = Mapper._group_by_grid(headers)
+        n_workers = max(1, min(n_jobs, len(imgs)))
+        if memory_budget is not None:
+            continuous = any(m in similarity.CONTINUOUS_METRICS for m in metrics)
+            for idx in grids:
+                Mapper.tile_shape(1, len(map_imgs), int(np.prod(headers[idx[0]].shape[:3])), memory_budget,
+                                  continuous=continuous, n_workers=n_workers, shared=True)
+        tmp_dir = tempfile.mkdtemp(prefix='ica_mapping_')
+        pool = Pool(processes=n_jobs)
+        try:
+            tasks = []
+            for g, idx in enumerate(grids):
+                map_arr = Mapper.template_masks(map_imgs, headers[idx[0]], threshold=threshold, cache=cache, bank=bank,
+                                                sparse=sparse)
+                if sparse:
+                    template_file = (os.path.join(tmp_dir, 'template_indices_%d.npy' % g), map_arr.indptr)
+                    np.save(template_file[0], map_arr.indices)
+                elif Mapper._is_whole_npy(map_arr.words):  # already on disk, e.g. the template bank
+                    template_file = map_arr.words.filename
+                else:
+                    template_file = os.path.join(tmp_dir, 'templates_%d.npy' % g)
+                    np.save(template_file, map_arr.words)
+                values_file = None
+                if any(m in similarity.CONTINUOUS_METRICS for m in metrics):
+                    values_file = os.path.join(tmp_dir, 'template_values_%d.npy' % g)
+                    np.save(values_file, Mapper.template_values(map_imgs, headers[idx[0]], cache=cache))
+                for block in np.array_split(np.asarray(idx), min(n_jobs, len(idx))):
+                    args = ([imgs[i] for i in block], template_file, values_file, map_arr.n_voxels, metrics,
+                            threshold, memory_budget, n_workers)
+                    tasks.append((block, pool.apply_async(_correlate_components, args)))
+            for block, task in tasks:
+                result = task.get()
+                for metric in metrics:
+                    scores[metric][block] = result[metric]
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return scores
+
+
+def _correlate_components(imgs, template_file, values_file, n_voxels, metrics, threshold, memory_budget=None,
+                          n_workers=1):
+    """
+    Worker task of `Mapper.parallel_similarities`: every metric for a block of components against shared templates.
+    `template_file` is the `.npy` of packed words, or for sparse templates a (`.npy` of indices, indptr) pair.
+    """
+    if isinstance(template_file, tuple):
+        map_arr = SparseMasks(np.load(template_file[0], mmap_mode='r'), template_file[1], n_voxels)
+    else:
+        map_arr = PackedMasks(np.load(template_file, mmap_mode='r'), n_voxels)
+    map_values = np.load(values_file, mmap_mode='r') if values_file is not None else None
+    if memory_budget is not None:
+        imgs = [img if is_image(img) else LazyImage(img) for img in imgs]
+        return Mapper.tiled_similarities(imgs, map_arr, map_values, metrics, threshold, memory_budget,
+                                         n_workers=n_workers)
+    return Mapper._block_similarities(imgs, map_arr, map_values, metrics, threshold)
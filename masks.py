@@ -0,0 +1,177 @@
+"""
+masks.py
+
+Compact binary masks. Each mask is bit-packed into 64-bit words (64 voxels per word), so a 2 mm MNI volume takes
+~110 KB instead of ~7 MB as a float64 vector, and overlap counts between masks reduce to bitwise AND plus popcount.
+Masks that cover only a small part of the volume (e.g. the parcels of a fine-grained atlas) can instead be stored
+sparsely, as the sorted voxel indices of each mask, with overlaps counted by indexed gathers.
+"""
+import numpy as np
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """Number of set bits along the last axis of an unsigned integer array."""
+    words = np.ascontiguousarray(words)
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0 has a native popcount ufunc
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def binarize(dat, threshold):
+    """Boolean mask of |dat| >= threshold (NaN excluded), without a temporary array of |dat|."""
+    mask = dat >= threshold
+    mask |= dat <= -threshold
+    return mask
+
+
+class PackedMasks(object):
+    """
+    A stack of binary masks over the same `n_voxels` voxels, stored as an (n_masks, n_words) uint64 array. Bits past
+    `n_voxels` in the last word are always zero, so they never contribute to a count.
+    """
+    def __init__(self, words, n_voxels):
+        self.words = np.atleast_2d(words)
+        self.n_voxels = n_voxels
+        self._counts = None
+
+    @classmethod
+    def from_dense(cls, arr):
+        """Pack a boolean (or 0/1) vector or (n_masks, n_voxels) matrix."""
+        arr = np.atleast_2d(arr)
+        n_voxels = arr.shape[1]
+        packed = np.packbits(arr != 0, axis=1)
+        pad = -packed.shape[1] % 8  # round up to whole 64-bit words
+        if pad:
+            packed = np.hstack([packed, np.zeros((packed.shape[0], pad), dtype=np.uint8)])
+        return cls(np.ascontiguousarray(packed).view(np.uint64), n_voxels)
+
+    @classmethod
+    def stack(cls, masks):
+        """Concatenate several `PackedMasks` defined over the same voxels."""
+        masks = list(masks)
+        n_voxels = masks[0].n_voxels
+        if any(m.n_voxels != n_voxels for m in masks):
+            raise ValueError('Cannot stack masks defined over different numbers of voxels')
+        return cls(np.vstack([m.words for m in masks]), n_voxels)
+
+    def to_dense(self):
+        """(n_masks, n_voxels) boolean matrix."""
+        return np.unpackbits(np.ascontiguousarray(self.words).view(np.uint8), axis=1)[:, :self.n_voxels].astype(bool)
+
+    def columns(self, start, stop):
+        """
+        The masks restricted to voxels [start, stop), as a view of the words; `start` and `stop` (unless it is
+        `n_voxels`) must be multiples of 64. Counts over consecutive column blocks add up to the counts of the masks.
+        """
+        stop = min(stop, self.n_voxels)
+        if start % 64 or (stop % 64 and stop != self.n_voxels):
+            raise ValueError('Column blocks of packed masks must start and end on 64-voxel words (%d, %d)'
+                             % (start, stop))
+        return PackedMasks(self.words[:, start // 64:-(-stop // 64)], stop - start)
+
+    def counts(self):
+        """Number of voxels set in each mask."""
+        if self._counts is None:
+            self._counts = popcount(self.words)
+        return self._counts
+
+    def overlap(self, other):
+        """(len(self), len(other)) matrix with the number of voxels set in both masks of every pair."""
+        if isinstance(other, SparseMasks):
+            return other.overlap(self).T
+        if self.n_voxels != other.n_voxels:
+            raise ValueError('Masks are defined over different numbers of voxels (%d, %d)'
+                             % (self.n_voxels, other.n_voxels))
+        tp = np.empty((len(self), len(other)), dtype=np.int64)
+        for i, row in enumerate(self.words):  # one (n_other, n_words) AND per mask keeps the working set small
+            tp[i] = popcount(np.bitwise_and(other.words, row))
+        return tp
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    def __getitem__(self, item):
+        return PackedMasks(self.words[item], self.n_voxels)
+
+
+class SparseMasks(object):
+    """
+    A stack of binary masks over the same `n_voxels` voxels, stored as the rows of a CSR matrix: the sorted voxel
+    indices of mask i are `indices[indptr[i]:indptr[i + 1]]`. Memory and overlap cost scale with the number of voxels
+    set rather than with the size of the volume.
+    """
+    def __init__(self, indices, indptr, n_voxels):
+        self.indices, self.indptr, self.n_voxels = indices, np.asarray(indptr, dtype=np.int64), n_voxels
+
+    @classmethod
+    def from_indices(cls, rows, n_voxels):
+        """Build from a list of sorted voxel index arrays, one per mask."""
+        rows = list(rows)
+        indptr = np.concatenate([[0], np.cumsum([len(r) for r in rows])]).astype(np.int64)
+        indices = np.concatenate(rows).astype(np.int32) if rows else np.zeros(0, dtype=np.int32)
+        return cls(indices, indptr, n_voxels)
+
+    @classmethod
+    def from_dense(cls, arr):
+        arr = np.atleast_2d(arr)
+        return cls.from_indices([np.flatnonzero(row) for row in arr], arr.shape[1])
+
+    @classmethod
+    def from_packed(cls, packed):
+        """Convert `PackedMasks`, unpacking one mask at a time."""
+        return cls.from_indices([np.flatnonzero(packed[i].to_dense()[0]) for i in range(len(packed))],
+                                packed.n_voxels)
+
+    def row(self, i):
+        """Sorted voxel indices of mask `i`."""
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def to_dense(self):
+        dense = np.zeros((len(self), self.n_voxels), dtype=bool)
+        for i in range(len(self)):
+            dense[i, self.row(i)] = True
+        return dense
+
+    def columns(self, start, stop):
+        """The masks restricted to voxels [start, stop), renumbered from 0 (see `PackedMasks.columns`)."""
+        stop = min(stop, self.n_voxels)
+        keep = (self.indices >= start) & (self.indices < stop)
+        kept = np.concatenate([[0], np.cumsum(keep, dtype=np.int64)])
+        return SparseMasks(self.indices[keep] - start, kept[self.indptr], stop - start)
+
+    def counts(self):
+        return np.diff(self.indptr)
+
+    def overlap(self, other):
+        """
+        (len(self), len(other)) overlap counts with `PackedMasks`, `SparseMasks` or a dense (n_masks, n_voxels)
+        matrix. Each mask of `other` is expanded to a dense boolean vector once and gathered at every stored index;
+        a cumulative sum then gives the count of each row.
+        """
+        other = other if isinstance(other, (PackedMasks, SparseMasks)) else PackedMasks.from_dense(other)
+        if self.n_voxels != other.n_voxels:
+            raise ValueError('Masks are defined over different numbers of voxels (%d, %d)'
+                             % (self.n_voxels, other.n_voxels))
+        tp = np.empty((len(self), len(other)), dtype=np.int64)
+        for j in range(len(other)):
+            if isinstance(other, PackedMasks):
+                x = other[j].to_dense()[0]
+            else:
+                x = np.zeros(self.n_voxels, dtype=bool)
+                x[other.row(j)] = True
+            hits = np.concatenate([[0], np.cumsum(x[self.indices], dtype=np.int64)])
+            tp[:, j] = hits[self.indptr[1:]] - hits[self.indptr[:-1]]
+        return tp
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.indptr.nbytes
+
+    def __len__(self):
+        return len(self.indptr) - 1
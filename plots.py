@@ -0,0 +1,87 @@
+"""
+plots.py
+
+Figure drawing shared by the GUI and report generation. Everything is drawn into a given matplotlib `Figure` without
+going through pyplot's current figure, so the same functions work on the embedded Qt canvases and on offscreen Agg
+figures in worker processes.
+"""
+import numpy as np
+import matplotlib.gridspec as gridspec
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from images import as_img
+import instrument
+
+
+def agg_figure(figsize, dpi=None):
+    """Figure with a non-interactive Agg canvas, usable off the GUI thread and in other processes."""
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def plot_brain_view(fig, anat_img, stat_img, title, display='ortho', coords=(0, 0, 0), contours=()):
+    """Stat map of `stat_img` over `anat_img`, with a contour for every (img, style) of `contours`."""
+    from nilearn import plotting  # slow to import, and not needed for thumbnails or time series
+    fig.clear()
+    ax1 = fig.add_subplot(111)
+    with instrument.span('render', display=display):
+        d = plotting.plot_stat_map(stat_map_img=stat_img, bg_img=anat_img, axes=ax1, title=title,
+                                   cut_coords=coords, display_mode=display, annotate=True,
+                                   draw_cross=True, colorbar=True)
+    for img, style in contours:
+        with instrument.span('contour'):
+            d.add_contours(img, filled=style['filled'], alpha=style['alpha'], levels=[style['levels']],
+                           colors=style['colors'])
+    ax1.set_axis_off()
+    fig.tight_layout(pad=0.01)
+
+
+def plot_time_series(fig, individual=None, average=None, show_group=False, show_spectrum=False, coords=(0, 0, 0)):
+    """
+    Voxel (`individual`) and/or component (`average`) time series, next to the group and spectrum panels when asked
+    for. Returns False, leaving the figure untouched, if there is nothing to draw.
+    """
+    show_ts = individual is not None or average is not None
+    if not show_ts and not show_group and not show_spectrum:
+        return False  # no plot to render
+    fig.clear()
+    gs = gridspec.GridSpec(2, 5)
+    axts = None
+    if not show_ts and show_group and not show_spectrum:
+        axgr = fig.add_subplot(gs[:, :])
+    if not show_ts and show_group and show_spectrum:
+        axgr, axps = fig.add_subplot(gs[:, 3:]), fig.add_subplot(gs[:, :3])
+    if show_ts and not show_group:
+        axts = fig.add_subplot(gs[:, :])
+    if show_ts and show_group and not show_spectrum:
+        axts, axgr = fig.add_subplot(gs[:, 3:]), fig.add_subplot(gs[:, :3])
+    if show_ts and show_group and show_spectrum:
+        axts, axgr, axps = fig.add_subplot(gs[:, 3:]), fig.add_subplot(gs[0, :3]), fig.add_subplot(gs[1, :3])
+
+    if individual is not None:
+        axts.plot(individual, label='Voxel (%d, %d, %d) Time-Series' % (coords[0], coords[1], coords[2]))
+    if average is not None:
+        axts.plot(average, label="Average Signal")
+    if axts is not None:
+        axts.set_xlabel('Time (s)')
+        axts.set_ylabel('fMRI signal')
+    if show_group:
+        # TODO: Plot Group Logic
+        pass
+    if show_spectrum:
+        # TODO: Plot Power Spectrum Logic
+        pass
+    fig.tight_layout(pad=0.1)
+    return True
+
+
+def plot_thumbnail(fig, stat_img):
+    """Small maximum-intensity projection (along z) of |component|, cheap enough to draw for whole cohorts."""
+    dat = np.abs(np.nan_to_num(np.asarray(as_img(stat_img).dataobj, dtype=np.float32)))
+    dat = dat.max(axis=2) if dat.ndim >= 3 else dat
+    fig.clear()
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(dat.reshape(dat.shape[:2]).T, origin='lower', cmap='hot', interpolation='nearest')
+    ax.set_axis_off()
@@ -1,31 +1,271 @@
 import os
+import re
+import csv
+import json
+import hashlib
 from jinja2 import Environment, FileSystemLoader
 from io import BytesIO
-import matplotlib.pyplot as plt
+from multiprocessing import Pool, cpu_count
 import base64
+import numpy as np
+from nibabel.nifti1 import Nifti1Image
+
+import instrument
+from images import LazyImage
+from files import file_hash, file_identity, replace_file
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_ENVIRONMENT = Environment(
     autoescape=False,
     loader=FileSystemLoader(os.path.join(PATH, 'templates')),
     trim_blocks=False)
+REPORT_VERSION = 1  # bump when the drawing or the templates change, so that every report is written again
+THUMBNAIL_DPI = 48
 
 
 def render_template(template_filename, context):
     return TEMPLATE_ENVIRONMENT.get_template(template_filename).render(context)
 
 
-def create_html(obj_dict, html_filename, template_html_filename='basic_report.html'):
-    context = obj_dict
-    for fig_name in ['mri_view', 'time_series']:
-        plt.figure(obj_dict[fig_name].number)
-        # fig = obj_dict[fig_name]  # make it current figure (?hack)
+def figure_source(fig, html_filename, asset_file=None):
+    """
+    `src` of an <img> showing `fig`: the PNG inline as a data URI or, with `asset_file`, the path of that PNG file
+    relative to the page. `fig` may be None if the asset file has already been written.
+    """
+    if asset_file is None:
         figfile = BytesIO()
-        plt.savefig(figfile, format='png')
+        with instrument.span('encode'):
+            fig.savefig(figfile, format='png')
         figfile.seek(0)  # rewind to beginning of file
-        figdata_png = base64.b64encode(figfile.getvalue())
-        context.update({fig_name: figdata_png.decode('utf8')})
+        return 'data:image/png;base64,' + base64.b64encode(figfile.getvalue()).decode('utf8')
+    if fig is not None:
+        if not os.path.exists(os.path.dirname(asset_file)):
+            try:
+                os.makedirs(os.path.dirname(asset_file))
+            except OSError:  # created meanwhile by another worker
+                pass
+        tmp_file = '%s.%d.tmp.png' % (asset_file, os.getpid())  # pages rendered in parallel may share the asset
+        with instrument.span('encode'):
+            fig.savefig(tmp_file, format='png')
+        replace_file(tmp_file, asset_file)
+    return os.path.relpath(asset_file, os.path.dirname(os.path.abspath(html_filename))).replace(os.sep, '/')
+
+
+def create_html(obj_dict, html_filename, template_html_filename='basic_report.html', assets=None):
+    """
+    Write a report page. `obj_dict` holds the 'mri_view' and 'time_series' figures and the template context; with
+    `assets` ({figure name: png file}) those figures are written to (or, if None, taken from) separate files.
+    """
+    context = obj_dict
+    assets = assets or {}
+    for fig_name in ['mri_view', 'time_series']:
+        context.update({fig_name: figure_source(obj_dict.get(fig_name), html_filename, assets.get(fig_name))})
 
-    with open(html_filename, 'w') as f:
+    with instrument.span('write', file=html_filename), open(html_filename, 'w') as f:
         html = render_template(template_html_filename, context)
         f.write(html)
+
+
+def _update_hash(sha, value, file_hashes):
+    """Feed `value` to `sha`; existing files are hashed by content (memoized in `file_hashes`), images by data."""
+    if isinstance(value, dict):
+        for k in sorted(value):
+            sha.update(repr(k).encode('utf8'))
+            _update_hash(sha, value[k], file_hashes)
+    elif isinstance(value, (list, tuple)):
+        sha.update(b'(')
+        for v in value:
+            _update_hash(sha, v, file_hashes)
+        sha.update(b')')
+    elif isinstance(value, LazyImage):
+        _update_hash(sha, value.file_name, file_hashes)
+    elif isinstance(value, Nifti1Image):
+        _update_hash(sha, (np.asarray(value.dataobj), value.affine), file_hashes)
+    elif isinstance(value, np.ndarray):
+        sha.update(repr((value.shape, value.dtype.str)).encode('utf8'))
+        sha.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, str) and os.path.isfile(value):
+        st = os.stat(value)
+        identity = (os.path.abspath(value), st.st_size, st.st_mtime)
+        if identity not in file_hashes:
+            file_hashes[identity] = file_hash(value)
+        sha.update(file_hashes[identity].encode('utf8'))
+    else:
+        sha.update(repr(value).encode('utf8'))
+
+
+def content_hash(value, file_hashes=None):
+    sha = hashlib.sha1(repr(REPORT_VERSION).encode('utf8'))
+    _update_hash(sha, value, {} if file_hashes is None else file_hashes)
+    return sha.hexdigest()[:16]
+
+
+def recorded_hash(html_filename):
+    """Content hash recorded in an existing report, or None."""
+    if not os.path.exists(html_filename):
+        return None
+    with open(html_filename) as f:
+        match = re.search(r'<meta name="report-hash" content="(\w*)">', f.read(4096))
+    return match.group(1) if match else None
+
+
+def render_report(job):
+    """
+    Draw and write the report of one mapped component. `job` holds the html file name, the title and the keyword
+    arguments of `plots.plot_brain_view` ('brain_view') and `plots.plot_time_series` ('time_series'); it only contains
+    picklable values (file names rather than loaded images) so that it can be sent to a worker process. With
+    'assets' ({figure name: png file}) figures go to separate files, and figures whose file exists are not redrawn.
+    """
+    import plots  # matplotlib is only imported by the processes that draw
+    assets = job.get('assets') or {}
+    fx = ft = None
+    if not os.path.exists(assets.get('mri_view', '')):
+        fx = plots.agg_figure((10, 4))
+        plots.plot_brain_view(fx, **job['brain_view'])
+    if not os.path.exists(assets.get('time_series', '')):
+        ft = plots.agg_figure((10, 2))
+        plots.plot_time_series(ft, **job['time_series'])
+    create_html({'mri_view': fx, 'time_series': ft, 'title': job['title'], 'report_hash': job.get('hash', '')},
+                job['html_file'], assets=assets)
+    return job['html_file']
+
+
+def plan_reports(jobs, assets_directory=None, force=False):
+    """
+    Add the content hash of its inputs (and, with `assets_directory`, shared figure files named by the hash of each
+    figure's inputs) to every job, and return only those whose page is missing or was written from other inputs.
+    """
+    file_hashes, todo = {}, []
+    for job in jobs:
+        job = dict(job)
+        if assets_directory is not None:
+            job['assets'] = {name: os.path.join(assets_directory, '%s_%s.png' % (name, content_hash(job[key],
+                                                                                                   file_hashes)))
+                             for name, key in (('mri_view', 'brain_view'), ('time_series', 'time_series'))}
+        inputs = content_hash({k: job[k] for k in ('title', 'brain_view', 'time_series')}, file_hashes)
+        outputs = repr((job['html_file'], sorted((job.get('assets') or {}).items())))  # names, not contents
+        job['hash'] = hashlib.sha1((inputs + outputs).encode('utf8')).hexdigest()[:16]
+        missing_assets = any(not os.path.exists(f) for f in (job.get('assets') or {}).values())
+        if force or missing_assets or recorded_hash(job['html_file']) != job['hash']:
+            todo.append(job)
+    return todo
+
+
+def generate_reports(jobs, n_jobs=-1, progress=None, assets_directory=None, force=False):
+    """
+    Render the reports of `jobs` whose inputs changed since they were last written (all of them with `force`) on a
+    pool of `n_jobs` processes, calling `progress(done, total)` as they finish. Returns the files written.
+    """
+    jobs = plan_reports(jobs, assets_directory=assets_directory, force=force)
+    if not jobs:
+        if progress is not None:
+            progress(0, 0)
+        return []
+    n_jobs = cpu_count() if n_jobs < 1 else n_jobs
+    n_jobs = max(1, min(n_jobs, len(jobs)))
+    html_files = []
+    if n_jobs == 1:
+        results, pool = (render_report(job) for job in jobs), None
+    else:
+        pool = Pool(processes=n_jobs)
+        results = pool.imap_unordered(render_report, jobs)
+    try:
+        for html_file in results:
+            html_files.append(html_file)
+            if progress is not None:
+                progress(len(html_files), len(jobs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return html_files
+
+
+def render_thumbnail(job):
+    """
+    Write the thumbnail png of one component unless it exists; `job` is (component file, png file, pixels). The png
+    file is named after the identity of the component file (see `summary_subjects`), so it is redrawn once that changes.
+    """
+    import plots
+    stat_file, png_file, size = job
+    if not os.path.exists(png_file):
+        fig = plots.agg_figure((size / float(THUMBNAIL_DPI), size / float(THUMBNAIL_DPI)), dpi=THUMBNAIL_DPI)
+        plots.plot_thumbnail(fig, stat_file)
+        tmp_file = '%s.%d.tmp.png' % (png_file, os.getpid())
+        fig.savefig(tmp_file, format='png', dpi=THUMBNAIL_DPI)
+        replace_file(tmp_file, png_file)
+    return png_file
+
+
+def read_subject_results(subject_directory):
+    """
+    (component, assignment, {network: score}) for every component of a subject mapped by `batch.py`, in the order of
+    its `correlations.csv` (scored by the first metric the subject was mapped with).
+    """
+    with open(os.path.join(subject_directory, 'assignments.json')) as f:
+        assignments = json.load(f)
+    with open(os.path.join(subject_directory, 'correlations.csv')) as f:
+        rows = list(csv.reader(f))
+    networks = rows[0][1:] if rows else []
+    for row in rows[1:]:
+        yield row[0], assignments.get(row[0], {}), dict(zip(networks, (float(c) for c in row[1:])))
+
+
+def summary_subjects(output_directory, subjects, top_k=3, thumbnail_size=96, pool=None):
+    """
+    Generator of the per-subject context of the summary page, one subject at a time, so that the page can be written
+    while later subjects are still being read and their thumbnails drawn (on `pool` if given).
+    """
+    html_directory = os.path.abspath(output_directory)
+    for subject in subjects:
+        subject_directory = os.path.join(output_directory, subject)
+        if not os.path.exists(os.path.join(subject_directory, 'assignments.json')):
+            continue
+        components = list(read_subject_results(subject_directory))
+        thumbnails = [None] * len(components)
+        if thumbnail_size:
+            thumbnail_directory = os.path.join(output_directory, 'thumbnails', subject)
+            if not os.path.exists(thumbnail_directory):
+                os.makedirs(thumbnail_directory)
+            jobs = [(a['file'], os.path.join(thumbnail_directory, '%s_%s_%d.png'
+                                             % (name, file_identity(a['file'])[:16], thumbnail_size)), thumbnail_size)
+                    for name, a, _ in components]
+            png_files = list((pool.imap if pool is not None else map)(render_thumbnail, jobs))
+            thumbnails = [os.path.relpath(os.path.abspath(f), html_directory).replace(os.sep, '/')
+                          for f in png_files]
+            current = set(os.path.basename(f) for f in png_files)
+            for stale in os.listdir(thumbnail_directory):  # of components mapped before, or drawn at another size
+                if stale.endswith('.png') and '.tmp' not in stale and stale not in current:
+                    os.remove(os.path.join(thumbnail_directory, stale))
+        yield {'name': subject,
+               'components': [{'name': name, 'network': a.get('network'), 'thumbnail': thumbnail,
+                               'top': sorted(scores.items(), key=lambda s: -s[1])[:top_k]}
+                              for (name, a, scores), thumbnail in zip(components, thumbnails)]}
+
+
+def create_summary(output_directory, subjects, html_filename=None, top_k=3, thumbnail_size=96, n_jobs=-1,
+                   metric='phi', template_html_filename='summary_report.html'):
+    """
+    Write one overview page of every subject and component mapped into `output_directory`, listing the `top_k`
+    networks by score next to a thumbnail of the component (none with `thumbnail_size=0`); `metric` names the metric
+    of the subjects' `correlations.csv` (the first one they were mapped with). The page is streamed to disk through
+    the template as subjects are processed, never held in memory as a whole.
+    """
+    html_filename = html_filename or os.path.join(output_directory, 'summary.html')
+    n_jobs = cpu_count() if n_jobs < 1 else n_jobs
+    pool = Pool(processes=n_jobs) if n_jobs > 1 and thumbnail_size else None
+    try:
+        context = {'title': 'Summary', 'top_k': top_k, 'metric': metric,
+                   'subjects': summary_subjects(output_directory, subjects, top_k=top_k,
+                                                thumbnail_size=thumbnail_size, pool=pool)}
+        stream = TEMPLATE_ENVIRONMENT.get_template(template_html_filename).stream(context)
+        stream.enable_buffering(16)  # write a few subjects at a time
+        tmp_file = html_filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            stream.dump(f)
+        replace_file(tmp_file, html_filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return html_filename
@@ -0,0 +1,97 @@
+"""
+similarity.py
+
+Similarity metrics between component maps and templates. Binary metrics are computed from the same confusion counts
+(the overlap `tp` of every pair, the number of voxels set in each map and the number of voxels `n`), so any number of
+them costs one counting pass; continuous metrics work on the stacked, unthresholded maps.
+"""
+import numpy as np
+
+
+def _safe_ratio(num, den):
+    """num / den, with 0 wherever the denominator is 0."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = num / den
+    return np.where(den == 0, 0., ratio)
+
+
+def _broadcast(x_sum, y_sum):
+    return np.asarray(x_sum, dtype=np.float64)[:, np.newaxis], np.asarray(y_sum, dtype=np.float64)[np.newaxis, :]
+
+
+def phi(tp, x_sum, y_sum, n):
+    """
+    Phi-correlation (Matthews correlation coefficient). The arithmetic follows `sklearn.metrics.matthews_corrcoef`
+    (with `y` as the true labels) term for term; every intermediate is an integer held exactly in float64, so the
+    values are identical.
+    """
+    n = float(n)
+    x_sum, y_sum = _broadcast(x_sum, y_sum)
+    n_correct = n - x_sum - y_sum + 2 * tp  # true positives + true negatives
+    cov_xy = n_correct * n - ((n - y_sum) * (n - x_sum) + y_sum * x_sum)
+    cov_xx = n ** 2 - ((n - x_sum) ** 2 + x_sum ** 2)
+    cov_yy = n ** 2 - ((n - y_sum) ** 2 + y_sum ** 2)
+    denom = cov_yy * cov_xx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coef = cov_xy / np.sqrt(denom)
+    return np.where(denom == 0, 0., coef)  # a constant map has no defined correlation, sklearn reports 0
+
+
+def dice(tp, x_sum, y_sum, n):
+    """Dice coefficient, 2 |X & Y| / (|X| + |Y|)."""
+    x_sum, y_sum = _broadcast(x_sum, y_sum)
+    return _safe_ratio(2. * tp, x_sum + y_sum)
+
+
+def jaccard(tp, x_sum, y_sum, n):
+    """Jaccard index, |X & Y| / |X | Y|."""
+    x_sum, y_sum = _broadcast(x_sum, y_sum)
+    return _safe_ratio(np.asarray(tp, dtype=np.float64), x_sum + y_sum - tp)
+
+
+def overlap(tp, x_sum, y_sum, n):
+    """Overlap coefficient, |X & Y| / min(|X|, |Y|)."""
+    x_sum, y_sum = _broadcast(x_sum, y_sum)
+    return _safe_ratio(np.asarray(tp, dtype=np.float64), np.minimum(x_sum, y_sum))
+
+
+def pearson(x, y):
+    """Pearson (spatial) correlation of every row of `x` (n_x, n_voxels) with every row of `y` (n_y, n_voxels)."""
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    return pearson_from_parts(pearson_parts(x, y, x.mean(axis=1, dtype=np.float64), y.mean(axis=1, dtype=np.float64)))
+
+
+def pearson_parts(x, y, x_mean, y_mean):
+    """
+    Co-moment and sums of squares of the rows of `x` and `y`, centered on their means over the whole volume
+    (`x_mean`, `y_mean`). Summed over consecutive blocks of voxels they give the parts of the whole volume, so
+    `pearson_from_parts` of that sum equals `pearson` of the complete rows.
+    """
+    x = np.atleast_2d(x).astype(np.float32)
+    y = np.atleast_2d(y).astype(np.float32)
+    x -= np.asarray(x_mean)[:, np.newaxis].astype(np.float32)
+    y -= np.asarray(y_mean)[:, np.newaxis].astype(np.float32)
+    return (np.dot(x, y.T).astype(np.float64), np.einsum('ij,ij->i', x, x, dtype=np.float64),
+            np.einsum('ij,ij->i', y, y, dtype=np.float64))
+
+
+def pearson_from_parts(parts):
+    cov, x_ss, y_ss = parts
+    return _safe_ratio(cov, np.outer(np.sqrt(x_ss), np.sqrt(y_ss)))
+
+
+BINARY_METRICS = {'phi': phi, 'dice': dice, 'jaccard': jaccard, 'overlap': overlap}
+CONTINUOUS_METRICS = {'pearson': pearson}
+# (parts of a block of voxels, metric from the summed parts) of every continuous metric, for tiled computation
+CONTINUOUS_PARTS = {'pearson': (pearson_parts, pearson_from_parts)}
+
+
+def check_metrics(metrics):
+    """Validate a list of metric names, returning it as a tuple."""
+    metrics = (metrics,) if isinstance(metrics, str) else tuple(metrics)
+    unknown = [m for m in metrics if m not in BINARY_METRICS and m not in CONTINUOUS_METRICS]
+    if unknown or not metrics:
+        raise ValueError('Unknown similarity metric(s) %s; choose from %s'
+                         % (', '.join(map(repr, unknown)) or 'none given',
+                            ', '.join(sorted(BINARY_METRICS) + sorted(CONTINUOUS_METRICS))))
+    return metrics
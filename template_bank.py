@@ -0,0 +1,174 @@
+"""
+template_bank.py
+
+Persistent on-disk index of binarized templates. For every target grid (shape, affine and threshold) the bank keeps
+one memory-mappable `.npy` file holding a bit-packed row per template (see `masks.PackedMasks`), next to a JSON
+manifest recording the source path, mtime, size and content hash of each row. Later sessions map the file instead of
+decompressing, resampling and thresholding every `.nii.gz` template again; only rows whose source changed are rebuilt.
+
+A rebuild writes the rows to a new generation of the `.npy` file and then atomically replaces the manifest, which
+names the generation its rows belong to, so that readers in other processes always see a matching pair. Within a
+process, lookups, rebuilds and manifest writes of all banks are serialized by one lock.
+"""
+import os
+from os.path import join as opj
+import json
+import hashlib
+import threading
+import numpy as np
+
+from masks import PackedMasks
+from files import file_hash, replace_file
+from images import LazyImage, as_img, is_image, image_path
+from mapper import Mapper
+import instrument
+
+DEFAULT_BANK_DIRECTORY = os.path.join(os.path.expanduser('~'), '.ica_mapping', 'template_bank')
+
+_lock = threading.Lock()  # guards the grids, manifests and row files of every bank in this process
+
+
+class TemplateBank(object):
+    """
+    Binarized templates per grid, stored under `directory`. `masks()` returns the packed masks of a list of template
+    files on the grid of a reference image, refreshing only the entries whose source file is new or has changed.
+    """
+    def __init__(self, directory=DEFAULT_BANK_DIRECTORY):
+        self.directory = directory
+        self.rebuilt = 0  # number of template rows (re)computed by this instance
+        self._grids = {}  # grid key -> (manifest, memory-mapped words)
+
+    @staticmethod
+    def grid_key(reference, threshold):
+        """Stable name for the (shape, affine, threshold) of a grid."""
+        sha = hashlib.sha1()
+        sha.update(repr(tuple(int(i) for i in reference.shape[:3])).encode('utf8'))
+        sha.update(np.asarray(reference.affine, dtype=np.float64).tobytes())
+        sha.update(repr(float(threshold)).encode('utf8'))
+        return sha.hexdigest()[:16]
+
+    def _manifest_file(self, key):
+        return opj(self.directory, key + '.json')
+
+    def _array_file(self, key, generation):
+        return opj(self.directory, '%s.%s.npy' % (key, generation))
+
+    def _load(self, key):
+        """Manifest and memory-mapped rows of a grid, or (None, None) if the grid has not been built yet."""
+        if key in self._grids:
+            return self._grids[key]
+        for _ in range(3):  # the generation named by the manifest may be removed by a rebuild in between
+            try:
+                with open(self._manifest_file(key)) as f:
+                    manifest = json.load(f)
+                if 'generation' not in manifest:  # written before generations, rebuild
+                    return None, None
+                self._grids[key] = manifest, np.load(self._array_file(key, manifest['generation']), mmap_mode='r')
+                return self._grids[key]
+            except (IOError, OSError, ValueError):
+                continue
+        return None, None
+
+    @staticmethod
+    def _status(entry, file_name):
+        """
+        Compare a manifest entry with the file on disk: 'current', 'touched' (new mtime, same contents) or 'stale'.
+        The content hash is only computed when the mtime or size differ.
+        """
+        st = os.stat(file_name)
+        if entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+            return 'current'
+        if entry['size'] == st.st_size and entry['sha1'] == file_hash(file_name):
+            entry['mtime'] = st.st_mtime
+            return 'touched'
+        return 'stale'
+
+    def masks(self, templates, reference, threshold=0.5):
+        """
+        `PackedMasks` of the `templates` (file paths or `LazyImage` handles) resampled to the grid of `reference` and
+        binarized at `threshold`, in the order given. Only the header of `reference` is read unless rows are rebuilt.
+        """
+        reference = reference if is_image(reference) else LazyImage(reference)
+        templates = [os.path.abspath(image_path(t)) for t in templates]
+        key = TemplateBank.grid_key(reference, threshold)
+        with _lock:
+            manifest, words = self._load(key)
+            entries = {e['path']: e for e in manifest['entries']} if manifest else {}
+            status = {t: TemplateBank._status(entries[t], t) if t in entries else 'stale' for t in templates}
+            stale = [t for t in templates if status[t] == 'stale']
+            if stale or manifest is None:
+                manifest, words = self._rebuild(key, templates, stale, manifest, words, reference, threshold)
+                entries = {e['path']: e for e in manifest['entries']}
+            elif 'touched' in status.values():
+                self._write_manifest(key, manifest)  # remember the new mtimes so the files are not hashed again
+        instrument.count('template_bank.hits', len(templates) - len(stale))
+        instrument.count('template_bank.misses', len(stale))
+        rows = [entries[t]['row'] for t in templates]
+        if rows == list(range(words.shape[0])):
+            return PackedMasks(words, manifest['n_voxels'])  # the bank file itself, still memory-mapped
+        return PackedMasks(words[rows], manifest['n_voxels'])
+
+    def _rebuild(self, key, templates, stale, previous, words, reference, threshold):
+        """Recompute the `stale` rows, keep every other row of the existing bank and write a new generation."""
+        reference = as_img(reference)
+        entries = {e['path']: e for e in previous['entries']} if previous else {}
+        stale = set(stale)
+        keep = [e for e in sorted(entries.values(), key=lambda e: e['row']) if e['path'] not in stale]
+        new = [t for t in templates if t in stale]
+        rows = [np.asarray(words[e['row']]) for e in keep]
+        for t in new:
+            rows.append(PackedMasks.from_dense(Mapper.prep_tmap(t, reference=reference, threshold=threshold)).words[0])
+            self.rebuilt += 1
+        n_voxels = int(np.prod(reference.shape[:3]))
+        generation = '%d-%d' % (int(previous['generation'].split('-')[0]) + 1 if previous else 1, os.getpid())
+        manifest = {'generation': generation,
+                    'shape': [int(i) for i in reference.shape[:3]],
+                    'affine': np.asarray(reference.affine).tolist(),
+                    'threshold': threshold,
+                    'n_voxels': n_voxels,
+                    'entries': []}
+        for row, e in enumerate(keep):
+            manifest['entries'].append(dict(e, row=row))
+        for row, t in enumerate(new, len(keep)):
+            st = os.stat(t)
+            manifest['entries'].append({'path': t, 'mtime': st.st_mtime, 'size': st.st_size, 'sha1': file_hash(t),
+                                        'row': row})
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created meanwhile by another process
+                pass
+        array_file = self._array_file(key, generation)
+        tmp_file = '%s.%d.tmp.npy' % (array_file, os.getpid())
+        np.save(tmp_file, np.vstack(rows))
+        replace_file(tmp_file, array_file)
+        self._write_manifest(key, manifest)  # the new rows become visible together with their manifest
+        self._grids[key] = manifest, np.load(array_file, mmap_mode='r')
+        if previous:
+            self._remove_generations(key, keep=(previous['generation'], generation))
+        return self._grids[key]
+
+    def _remove_generations(self, key, keep):
+        """Delete the row files of older generations; the previous one stays for readers that just read its manifest."""
+        prefix = key + '.'
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith('.npy') and '.tmp' not in name and \
+                    name[len(prefix):-len('.npy')] not in keep:
+                try:
+                    os.remove(opj(self.directory, name))
+                except OSError:  # still mapped (windows) or removed by another process
+                    pass
+
+    def _write_manifest(self, key, manifest):
+        manifest_file = self._manifest_file(key)
+        tmp_file = '%s.%d.tmp' % (manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        replace_file(tmp_file, manifest_file)
+
+    def clear(self):
+        """Forget the grids mapped by this instance (the files on disk are kept)."""
+        with _lock:
+            self._grids = {}
+
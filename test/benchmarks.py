@@ -0,0 +1,232 @@
+"""
+benchmarks.py
+
+Timings of the mapping, loading and reporting hot paths on synthetic data, run from the repository root:
+
+    python -m test.benchmarks [-o <results.json>] [-r <mm,...>] [-c <n_components,...>] [-t <n_templates>]
+                              [-n <repeats>] [-s]
+
+For every resolution (voxel size in mm, on an MNI-sized bounding box) and component count, random smooth ICA maps
+and binary templates are written as .nii.gz files, then `Mapper.prep_tmap`, `Mapper.spatial_correlations`,
+`Mapper.run`, `Mapper.assign_matches` and `reports.create_html` are timed. Each benchmark is run once untimed first,
+so that deferred imports and first-use caches are not measured; each result then records the wall time and the peak
+of memory allocated during every repeat (tracemalloc, python 3 only). The JSON output can be compared between runs
+and machines.
+
+First, the import time of the entry modules is measured in fresh interpreters and checked against `STARTUP_TARGETS`;
+the exit status is 1 if one is missed. `-s` runs only this check.
+"""
+import os
+from os.path import join as opj
+import sys
+import json
+import time
+import shutil
+import getopt
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mapper as map
+import plots
+import reports
+
+USAGE = ('python -m test.benchmarks [-o <results.json>] [-r <mm,...>] [-c <n_components,...>] [-t <n_templates>] '
+         '[-n <repeats>] [-s]')
+STARTUP_TARGETS = {  # seconds to import each entry point in a fresh interpreter (heavy libraries load on first use)
+    'mapper': 0.5,
+    'batch': 0.5,
+    'ica_mapping_gui': 2.0,  # needs PyQt4; skipped where it is not installed
+}
+MNI_BOX = (182., 218., 182.)  # mm covered by the MNI152 templates
+RESOLUTIONS = (3, 2, 1)
+COMPONENT_COUNTS = (10, 50, 200)
+N_TEMPLATES = 20
+REPEATS = 3
+
+
+def grid(resolution):
+    """Shape and affine of an MNI-sized grid with `resolution` mm voxels."""
+    shape = tuple(int(round(s / resolution)) for s in MNI_BOX)
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = [-90., -126., -72.]
+    return shape, affine
+
+
+def smooth_field(shape, rng, n_blobs=6):
+    """Sum of random gaussian blobs, scaled like a z-map (roughly -5 to 5)."""
+    coords = np.ogrid[tuple(slice(0, s) for s in shape)]
+    field = np.zeros(shape, dtype=np.float32)
+    for _ in range(n_blobs):
+        center = [rng.uniform(0.2, 0.8) * s for s in shape]
+        width = rng.uniform(0.03, 0.1) * min(shape)
+        dist2 = sum((c - m) ** 2 for c, m in zip(coords, center))
+        field += (rng.choice([-1., 1.]) * rng.uniform(2., 5.) * np.exp(-dist2 / (2 * width ** 2))).astype(np.float32)
+    return field
+
+
+def make_dataset(directory, resolution, n_components, n_templates, seed=0):
+    """Write synthetic components and templates; returns (component files, template files)."""
+    rng = np.random.RandomState(seed)
+    shape, affine = grid(resolution)
+    files = {'ica': [], 'rsn': []}
+    for kind, n in (('ica', n_components), ('rsn', n_templates)):
+        if not os.path.exists(opj(directory, kind)):
+            os.makedirs(opj(directory, kind))
+        for i in range(n):
+            dat = smooth_field(shape, rng)
+            if kind == 'rsn':
+                dat = (np.abs(dat) > 1.).astype(np.float32)
+            files[kind].append(opj(directory, kind, '%s_%03d.nii.gz' % (kind, i)))
+            nib.save(nib.Nifti1Image(dat, affine), files[kind][-1])
+    return files['ica'], files['rsn']
+
+
+def measure(fn, repeats=REPEATS, setup=None):
+    """
+    Wall time and peak memory in MB of every repeat of `fn()` (after `setup()`, untimed), after one untimed warm-up
+    run. `peak_mb` is the median of the peaks of the repeats.
+    """
+    if setup is not None:
+        setup()
+    fn()  # warm-up: deferred imports, first-use caches
+    wall, peaks = [], []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time.time()
+        fn()
+        wall.append(time.time() - start)
+        if tracemalloc is not None:
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024. ** 2)
+            tracemalloc.stop()
+    return {'wall_s': wall, 'min_s': min(wall), 'median_s': float(np.median(wall)),
+            'peak_mb_per_repeat': peaks or None, 'peak_mb': float(np.median(peaks)) if peaks else None}
+
+
+def benchmark_dataset(ica_files, rsn_files, repeats=REPEATS):
+    """Results of every benchmark on one dataset, as {name: measure(...)}."""
+    cache = map.TemplateCache()
+    results = {}
+    results['prep_tmap'] = measure(lambda: [map.Mapper.prep_tmap(f, reference=ica_files[0]) for f in rsn_files],
+                                   repeats)
+    results['spatial_correlations'] = measure(
+        lambda: map.Mapper.spatial_correlations(ica_files, rsn_files, cache=cache), repeats, setup=cache.clear)
+    mappers = []
+
+    def run():
+        mappers.append(map.Mapper(map_files=rsn_files, in_files=ica_files, template_cache=map.TemplateCache()))
+        mappers[-1].run()
+    results['run'] = measure(run, repeats)
+    results['assign_matches'] = measure(lambda: mappers[-1].assign_matches(minimum_correlation=0.3), repeats)
+
+    fx, ft = plots.agg_figure((10, 4)), plots.agg_figure((10, 2))
+    fx.add_subplot(111).imshow(np.asarray(nib.load(ica_files[0]).dataobj).max(axis=2))
+    ft.add_subplot(111).plot(np.random.RandomState(0).randn(200))
+    html_file = opj(os.path.dirname(ica_files[0]), 'report.html')
+    results['create_html'] = measure(
+        lambda: reports.create_html({'mri_view': fx, 'time_series': ft, 'title': 'benchmark'}, html_file), repeats)
+    return results
+
+
+def import_time(module, path=ROOT):
+    """Seconds to import `module` in a new interpreter (interpreter start-up excluded), None if it cannot be imported."""
+    code = ('import sys, time; sys.path[:0] = [%r, %r]; start = time.time(); import %s; '
+            'sys.stdout.write(repr(time.time() - start))' % (path, ROOT, module))
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = process.communicate()
+    return float(out.decode('utf8')) if process.returncode == 0 else None
+
+
+def startup_benchmarks(repeats=REPEATS, log=sys.stderr):
+    """Import time of every module of `STARTUP_TARGETS`, best of `repeats`, with whether it meets its target."""
+    results = []
+    for module, target in sorted(STARTUP_TARGETS.items()):
+        path = opj(ROOT, 'gui') if module == 'ica_mapping_gui' else ROOT
+        wall = [import_time(module, path) for _ in range(repeats)]
+        if None in wall:
+            log.write('%-22s could not be imported, skipped\n' % module)
+            continue
+        results.append({'benchmark': 'startup', 'module': module, 'wall_s': wall, 'min_s': min(wall),
+                        'median_s': float(np.median(wall)), 'target_s': target, 'ok': min(wall) <= target})
+        log.write('%-22s import %6.3f s (target %.1f s)%s\n'
+                  % (module, min(wall), target, '' if results[-1]['ok'] else '  MISSED'))
+    return results
+
+
+def run_benchmarks(resolutions=RESOLUTIONS, component_counts=COMPONENT_COUNTS, n_templates=N_TEMPLATES,
+                   repeats=REPEATS, startup_only=False, log=sys.stderr):
+    """Run every benchmark for every (resolution, component count); returns the JSON-serializable results."""
+    output = {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                       'processor': platform.processor(), 'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count')
+                       else None, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeats': repeats},
+              'results': startup_benchmarks(repeats, log)}
+    for resolution in (() if startup_only else resolutions):
+        for n_components in component_counts:
+            directory = tempfile.mkdtemp(prefix='ica_mapping_benchmark_')
+            try:
+                ica_files, rsn_files = make_dataset(directory, resolution, n_components, n_templates)
+                for name, result in sorted(benchmark_dataset(ica_files, rsn_files, repeats).items()):
+                    result.update({'benchmark': name, 'resolution_mm': resolution, 'n_components': n_components,
+                                   'n_templates': n_templates, 'n_voxels': int(np.prod(grid(resolution)[0]))})
+                    output['results'].append(result)
+                    log.write('%-22s %g mm %4d components: %8.3f s (min), %s MB peak\n'
+                              % (name, resolution, n_components, result['min_s'],
+                                 '%.1f' % result['peak_mb'] if result['peak_mb'] is not None else '?'))
+                    log.flush()
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return output
+
+
+def main(argv):
+    output_file, resolutions, component_counts = None, RESOLUTIONS, COMPONENT_COUNTS
+    n_templates, repeats, startup_only = N_TEMPLATES, REPEATS, False
+    try:
+        opts, args = getopt.getopt(argv, "ho:r:c:t:n:s", ["output=", "resolutions=", "components=", "templates=",
+                                                          "repeats=", "startup"])
+    except getopt.GetoptError:
+        sys.stderr.write(USAGE + '\n')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            sys.stdout.write(USAGE + '\n')
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-r", "--resolutions"):
+            resolutions = tuple(float(r) for r in arg.split(','))
+        elif opt in ("-c", "--components"):
+            component_counts = tuple(int(c) for c in arg.split(','))
+        elif opt in ("-t", "--templates"):
+            n_templates = int(arg)
+        elif opt in ("-n", "--repeats"):
+            repeats = int(arg)
+        elif opt in ("-s", "--startup"):
+            startup_only = True
+
+    output = run_benchmarks(resolutions, component_counts, n_templates, repeats, startup_only)
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if not all(r['ok'] for r in output['results'] if r['benchmark'] == 'startup'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+"""
+test_similarity.py
+
+Batched phi-correlation against `sklearn.metrics.matthews_corrcoef`, pair by pair, on random masks:
+
+    python -m pytest test/test_similarity.py
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import similarity
+from masks import PackedMasks, SparseMasks
+
+try:
+    from sklearn.metrics import matthews_corrcoef
+except ImportError:
+    matthews_corrcoef = None
+
+
+@unittest.skipIf(matthews_corrcoef is None, 'scikit-learn is not installed')
+class TestPhi(unittest.TestCase):
+    def check(self, x, y):
+        """Batched phi from packed and sparse overlap counts equals sklearn for every pair of rows."""
+        px, py = PackedMasks.from_dense(x), PackedMasks.from_dense(y)
+        for tp in (px.overlap(py), SparseMasks.from_dense(x).overlap(py)):
+            phi = similarity.phi(tp, px.counts(), py.counts(), x.shape[1])
+            expected = np.array([[matthews_corrcoef(b, a) for b in y] for a in x])
+            np.testing.assert_array_equal(phi, expected)
+
+    def test_random_masks(self):
+        rng = np.random.RandomState(0)
+        for n_voxels, density in ((1000, 0.5), (4099, 0.05), (64 * 37, 0.9)):
+            self.check(rng.rand(6, n_voxels) < density, rng.rand(5, n_voxels) < density)
+
+    def test_constant_masks(self):
+        rng = np.random.RandomState(1)
+        x = rng.rand(4, 500) < 0.3
+        x[1], x[2] = False, True  # empty and full components
+        y = rng.rand(3, 500) < 0.3
+        y[0] = False
+        self.check(x, y)
+
+
+if __name__ == '__main__':
+    unittest.main()
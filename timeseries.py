@@ -0,0 +1,212 @@
+"""
+timeseries.py
+
+Time-series extraction from the 4-D fMRI without re-reading it on every plot. An uncompressed float32 NIfTI file is
+memory-mapped as it is; any other fMRI is converted once into a memory-mappable (n_voxels, n_volumes) float32 `.npy`
+file, streaming it in chunks of volumes so that files larger than memory can be used, and a voxel's signal is then a
+single row read. Converted files beyond a size budget are deleted, least recently used first, and only one thread of
+a process converts a given file at a time. The mean signal of thresholded components is computed for any number of
+components in one pass over that array and cached on disk, keyed by the fMRI file, the component contents and the
+threshold.
+"""
+import os
+from os.path import join as opj
+import hashlib
+import threading
+import numpy as np
+import nibabel as nib
+
+from images import as_img, image_path, iter_volume_chunks, voxel_data
+from files import file_hash, file_identity, replace_file
+import instrument
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.ica_mapping', 'timeseries')
+DEFAULT_MAX_CACHE_BYTES = 4 * 1024 ** 3  # converted fMRI files kept before the least recently used are deleted
+
+_lock = threading.Lock()
+_conversions = {}  # converted file -> lock held while it is being written
+
+
+def _conversion_lock(array_file):
+    with _lock:
+        return _conversions.setdefault(array_file, threading.Lock())
+
+
+def _tmp_file(file_name):
+    """Temporary name for writing `file_name`, unique to this process and thread."""
+    return '%s.%d-%d.tmp.npy' % (file_name, os.getpid(), threading.current_thread().ident)
+
+
+class TimeSeriesStore(object):
+    """
+    Signals of one 4-D fMRI file, cached under `directory`. `voxel_signal()` reads one voxel and `mean_signals()` the
+    average signal inside each thresholded component. Converted fMRI files in `directory` are kept up to
+    `max_cache_bytes` in total.
+    """
+    def __init__(self, fmri_file, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=256 * 1024 ** 2,
+                 max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.fmri_file = image_path(fmri_file) or fmri_file
+        self.directory = directory
+        self.max_bytes = max_bytes  # working set of a chunk of volumes or a block of voxels
+        self.max_cache_bytes = max_cache_bytes
+        header = nib.load(self.fmri_file)  # header only
+        self.shape, self.affine = header.shape, header.affine
+        proxy = header.dataobj
+        # an uncompressed float32 file without scaling is its own (Fortran ordered) memory map
+        self._offset = int(proxy.offset) if self.fmri_file.endswith('.nii') and proxy.dtype == np.float32 and \
+            float(proxy.slope) == 1 and float(proxy.inter) == 0 else None
+        self.voxel_order = 'F' if self._offset is not None else 'C'
+        self.fmri_key = file_identity(self.fmri_file)[:16]
+        self._data = None
+        self._signals = {}  # signal key -> mean signal, in front of the files on disk
+        self._hashes = {}  # (path, size, mtime) -> content hash of component files
+
+    @property
+    def array_file(self):
+        return opj(self.directory, 'fmri_%s.npy' % self.fmri_key)
+
+    @property
+    def ready(self):
+        """True if `data` can be mapped without converting the fMRI first."""
+        return self._data is not None or self._offset is not None or os.path.exists(self.array_file)
+
+    @property
+    def data(self):
+        """
+        (n_voxels, n_volumes) float32 memory map of the fMRI, voxels in `voxel_order` of the 3-D grid: 'F' for the
+        fMRI file itself, 'C' for a converted copy. The first access may convert the file; see `ready`.
+        """
+        if self._data is None:
+            n_voxels, n_volumes = int(np.prod(self.shape[:3])), (self.shape[3] if len(self.shape) > 3 else 1)
+            if self._offset is not None:
+                self._data = np.memmap(self.fmri_file, dtype=np.float32, mode='r', offset=self._offset,
+                                       shape=(n_voxels, n_volumes), order='F')
+                return self._data
+            array_file = self.array_file
+            with _conversion_lock(array_file):  # another thread may be converting it already
+                if os.path.exists(array_file):
+                    os.utime(array_file, None)  # most recently used, see _evict
+                else:
+                    with instrument.span('load', file=self.fmri_file):
+                        self._convert(array_file, n_voxels, n_volumes)
+                    self._evict(keep=array_file)
+            self._data = np.load(array_file, mmap_mode='r')
+        return self._data
+
+    def _make_directory(self):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # created meanwhile by another process
+                pass
+
+    def _convert(self, array_file, n_voxels, n_volumes):
+        self._make_directory()
+        tmp_file = _tmp_file(array_file)
+        out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(n_voxels, n_volumes))
+        for start, chunk in iter_volume_chunks(self.fmri_file, max_bytes=self.max_bytes):
+            out[:, start:start + chunk.shape[3]] = chunk.reshape(n_voxels, chunk.shape[3])
+        out.flush()
+        del out
+        replace_file(tmp_file, array_file)
+
+    def _evict(self, keep):
+        """Delete the least recently used converted files of `directory` (but `keep`) beyond `max_cache_bytes`."""
+        arrays = []
+        for name in os.listdir(self.directory):
+            path = opj(self.directory, name)
+            if name.startswith('fmri_') and name.endswith('.npy') and '.tmp' not in name and path != keep:
+                try:
+                    st = os.stat(path)
+                except OSError:  # removed meanwhile by another process
+                    continue
+                arrays.append((st.st_mtime, st.st_size, path))
+        total = os.path.getsize(keep) + sum(size for _, size, _ in arrays)
+        for _, size, path in sorted(arrays):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:  # still mapped (windows) or removed by another process
+                pass
+
+    def iter_voxel_blocks(self, voxels=None):
+        """(voxel indices, (n, n_volumes) signals) blocks of `voxels` (default: all), each within `max_bytes`."""
+        data = self.data
+        voxels = np.arange(data.shape[0]) if voxels is None else voxels
+        n_per_block = max(1, self.max_bytes // (data.shape[1] * data.dtype.itemsize))
+        for start in range(0, len(voxels), n_per_block):
+            block = voxels[start:start + n_per_block]
+            yield block, data[block]
+
+    def voxel_index(self, coords):
+        """Row of `data` of the voxel nearest to world `coords` (mm), or None outside the image."""
+        ijk = np.round(np.dot(np.linalg.inv(self.affine), list(coords[:3]) + [1.])[:3]).astype(int)
+        if np.any(ijk < 0) or np.any(ijk >= self.shape[:3]):
+            return None
+        return int(np.ravel_multi_index(tuple(ijk), self.shape[:3], order=self.voxel_order))
+
+    def voxel_signal(self, coords):
+        index = self.voxel_index(coords)
+        return np.zeros(0, dtype=np.float32) if index is None else np.array(self.data[index])
+
+    def _component_hash(self, img):
+        file_name = image_path(img)
+        if file_name is None:
+            return hashlib.sha1(np.ascontiguousarray(as_img(img).dataobj).tobytes()).hexdigest()
+        st = os.stat(file_name)
+        identity = (os.path.abspath(file_name), st.st_size, st.st_mtime)
+        if identity not in self._hashes:
+            self._hashes[identity] = file_hash(file_name)
+        return self._hashes[identity]
+
+    def _signal_key(self, img, threshold):
+        sha = hashlib.sha1(self.fmri_key.encode('utf8'))
+        sha.update(self._component_hash(img).encode('utf8'))
+        sha.update(repr(float(threshold)).encode('utf8'))
+        return sha.hexdigest()[:16]
+
+    def _mask(self, img, threshold):
+        """|component| > threshold, resampled (nearest) onto the fMRI grid and raveled in `voxel_order`."""
+        from nilearn import image  # deferred like everywhere else, see mapper
+        img = as_img(img)
+        dat = voxel_data(img)
+        mask = image.new_img_like(img, ((dat > threshold) | (dat < -threshold)).view(np.uint8))  # NaN is outside
+        mask = image.resample_img(mask, target_affine=self.affine, target_shape=self.shape[:3],
+                                  interpolation='nearest')
+        return (np.asanyarray(mask.dataobj) > 0).ravel(order=self.voxel_order)
+
+    def mean_signals(self, imgs, threshold=0.5):
+        """(n_components, n_volumes) mean fMRI signal inside each thresholded component of `imgs`."""
+        keys = [self._signal_key(img, threshold) for img in imgs]
+        missing = []
+        for img, key in zip(imgs, keys):
+            signal_file = opj(self.directory, 'signal_%s.npy' % key)
+            if key not in self._signals and os.path.exists(signal_file):
+                self._signals[key] = np.load(signal_file)
+            if key not in self._signals and key not in [k for _, k in missing]:
+                missing.append((img, key))
+        instrument.count('timeseries.hits', len(keys) - len(missing))
+        instrument.count('timeseries.misses', len(missing))
+        if missing:
+            with instrument.span('extract', components=len(missing)):
+                self._compute([img for img, _ in missing], [key for _, key in missing], threshold)
+        return np.vstack([self._signals[key] for key in keys]) if keys else np.zeros((0, self.shape[-1]))
+
+    def _compute(self, imgs, keys, threshold):
+        """Mean signals of all `imgs` in one pass over the voxels that belong to any of them."""
+        weights = np.vstack([self._mask(img, threshold) for img in imgs]).astype(np.float32)
+        counts = weights.sum(axis=1)
+        voxels = np.flatnonzero(weights.any(axis=0))
+        sums = np.zeros((len(imgs), self.data.shape[1]), dtype=np.float64)
+        for block, signals in self.iter_voxel_blocks(voxels):
+            sums += np.dot(weights[:, block], signals)
+        means = (sums / np.maximum(counts, 1)[:, np.newaxis]).astype(np.float32)
+        self._make_directory()  # not created by `data` for a file mapped directly
+        for key, signal in zip(keys, means):
+            self._signals[key] = signal
+            signal_file = opj(self.directory, 'signal_%s.npy' % key)
+            tmp_file = _tmp_file(signal_file)
+            np.save(tmp_file, signal)
+            replace_file(tmp_file, signal_file)